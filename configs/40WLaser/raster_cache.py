@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#
+# On-disk cache of raster_engrave.py's work
+#
+# Entries are files named by a hash of everything that went into them:
+# the bytes of the image and the parameters that change the result.  The
+# scaled and dithered dots, the packed words of the rows and the finished
+# gcode are kept separately, so a change that only touches the gcode
+# around the rows (power, origin, speed) still skips the scaling,
+# dithering and packing.  The rows are written a band at a time as they
+# are encoded, as plain arrays of their words.  Files are written under a
+# temporary name and renamed, so a job that is stopped part way leaves
+# nothing behind, and the least recently used files go once the directory
+# is over its size.
+
+import os, shutil, hashlib, json
+from contextlib import contextmanager
+import numpy
+
+# ends of the names of each kind of entry
+DOTS = '.npz'
+ROWS = '.bands'
+GCODE = '.ngc'
+PNG = '.png'
+
+
+def image_hash(image):
+    """Return a hash of an image file's bytes or of a PIL image's pixels"""
+    digest = hashlib.sha1()
+    if isinstance(image, basestring):
+        with open(image, 'rb') as f:
+            for block in iter(lambda: f.read(1<<20), ''):
+                digest.update(block)
+    else:
+        digest.update(repr((image.mode, image.size)))
+        digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def band_arrays(encoded_rows):
+    """Return the arrays a band of encoded rows is saved as
+
+    One row of the first array per segment: y, forward, first_non_zero,
+    last_non_zero, BPF, runs, which words, and the copies pitch and count
+    (0 for none).  Then the number of each of the words and the words one
+    after another, words shared by segments are only saved once.
+    """
+    segments = []
+    words = []
+    which = {}
+    for y, forward, row in encoded_rows:
+        for first_non_zero, last_non_zero, BPF, segment_words, calls, runs, copies in row:
+            if id(segment_words) not in which:
+                which[id(segment_words)] = len(words)
+                words.append(segment_words)
+            pitch, count = copies or (0, 0)
+            segments.append((y, forward, first_non_zero, last_non_zero, BPF, runs,
+                             which[id(segment_words)], pitch, count))
+    return (numpy.array(segments, dtype=numpy.int64),
+            numpy.array([len(w) for w in words], dtype=numpy.int64),
+            numpy.concatenate(words).astype(numpy.uint64))
+
+def band_rows(segments, lengths, words):
+    """Return the encoded rows of band_arrays(), without their calls"""
+    words = numpy.split(words, numpy.cumsum(lengths)[:-1])
+    encoded_rows = []
+    for (y, forward, first_non_zero, last_non_zero, BPF, runs,
+         which, pitch, count) in segments.tolist():
+        segment = (first_non_zero, last_non_zero, BPF, words[which], None, bool(runs),
+                   (pitch, count) if count else None)
+        if encoded_rows and encoded_rows[-1][0] == y:
+            encoded_rows[-1][2].append(segment)
+        else:
+            encoded_rows.append((y, bool(forward), [segment]))
+    return encoded_rows
+
+def key(*parts):
+    """Return the hash naming an entry made from parts
+
+    Parts are anything repr() writes the same way every run: strings,
+    numbers, tuples and sorted lists of them.
+    """
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+class RasterCache(object):
+    """A directory of cache entries holding at most max_bytes"""
+
+    def __init__(self, path, max_bytes):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def name(self, entry, kind):
+        return os.path.join(self.path, entry + kind)
+
+    def get(self, entry, kind):
+        """Return the file name of an entry, None if it isn't cached"""
+        name = self.name(entry, kind)
+        try:
+            # the modification time is when it was last used
+            os.utime(name, None)
+        except OSError:
+            return None
+        return name
+
+    @contextmanager
+    def writing(self, entry, kind):
+        """Open a file for an entry, which is cached if the block finishes"""
+        name = self.name(entry, kind)
+        temp = '%s.%u.tmp' % (name, os.getpid())
+        try:
+            with open(temp, 'wb') as f:
+                yield f
+            os.rename(temp, name)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        self.evict()
+
+    def put(self, entry, kind, write):
+        """Cache an entry, write(f) writes it to an open file"""
+        with self.writing(entry, kind) as f:
+            write(f)
+
+    def evict(self):
+        """Remove the least recently used entries until under max_bytes"""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def load_file(self, entry, kind, name):
+        """Copy an entry to the file name, False if it isn't cached"""
+        cached = self.get(entry, kind)
+        if cached is None:
+            return False
+        shutil.copyfile(cached, name)
+        return True
+
+    def save_file(self, entry, kind, name):
+        """Cache a copy of the file name"""
+        with open(name, 'rb') as source:
+            self.put(entry, kind, lambda f: shutil.copyfileobj(source, f))
+
+    def load_dots(self, entry):
+        """Return the (dots, notes) of a dots entry, None if not cached"""
+        name = self.get(entry, DOTS)
+        if name is None:
+            return None
+        with numpy.load(name, allow_pickle=False) as data:
+            dots = data['dots']
+            if 'width' in data:
+                dots = numpy.unpackbits(dots, axis=1)[:,:int(data['width'])].astype(bool)
+            return dots, [str(note) for note in json.loads(str(data['notes']))]
+
+    def save_dots(self, entry, dots, notes):
+        # on/off dots are packed 8 to a byte, compressing takes longer
+        # than making them again
+        arrays = dict(dots=dots, notes=json.dumps(notes))
+        if dots.dtype == bool:
+            arrays.update(dots=numpy.packbits(dots, axis=1), width=dots.shape[1])
+        self.put(entry, DOTS, lambda f: numpy.savez(f, **arrays))
+
+    def read_rows(self, entry):
+        """Return the (notes, bands, stats) of a rows entry, None if not cached
+
+        bands yields the encoded rows of each band with None for their
+        calls, stats is filled in once the last band has gone.
+        """
+        name = self.get(entry, ROWS)
+        if name is None:
+            return None
+        f = open(name, 'rb')
+        notes = [str(note) for note in json.loads(str(numpy.load(f, allow_pickle=False)))]
+        stats = {}
+        def bands():
+            with f:
+                while True:
+                    segments = numpy.load(f, allow_pickle=False)
+                    # no segments ends the bands
+                    if not len(segments):
+                        break
+                    yield band_rows(segments, numpy.load(f, allow_pickle=False), numpy.load(f, allow_pickle=False))
+                stats.update(json.loads(str(numpy.load(f, allow_pickle=False))))
+        return notes, bands(), stats
+
+    def write_rows(self, entry, notes, bands, stats):
+        """Yield the bands of encoded rows, caching them a band at a time
+
+        Nothing is cached if the bands aren't read to the end, by which
+        time stats are filled in.
+        """
+        with self.writing(entry, ROWS) as f:
+            numpy.save(f, numpy.array(json.dumps(notes)))
+            for encoded_rows in bands:
+                if encoded_rows:
+                    for array in band_arrays(encoded_rows):
+                        numpy.save(f, array)
+                yield encoded_rows
+            numpy.save(f, numpy.zeros((0, 9), dtype=numpy.int64))
+            numpy.save(f, numpy.array(json.dumps(stats)))
+
+    def read_gcode(self, entry):
+        """Yield the lines of a gcode entry in chunks, None if not cached"""
+        name = self.get(entry, GCODE)
+        if name is None:
+            return None
+        def chunks():
+            with open(name) as f:
+                for lines in iter(lambda: f.readlines(1<<16), []):
+                    yield ''.join(lines)
+        return chunks()
+
+    def write_gcode(self, entry, chunks):
+        """Yield the gcode chunks, caching them once the last has gone
+
+        Nothing is cached if the gcode isn't read to the end.
+        """
+        with self.writing(entry, GCODE) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# Check raster_engrave.py and laserraster.comp against each other
+#
+# Each job in JOBS is generated from the image with raster_engrave.py and
+# burnt by raster_sim.py, which runs laserraster's header, load and step
+# math.  A job passes when every dot of its actual_image burns at the
+# right level and no line stops moving the wrong way, which a clean job
+# never does.  Run it after changing either of them:
+#
+#     python raster_check.py [image] [-j job ...] [-k dir]
+
+import os, sys, shutil, tempfile, time
+from PIL import Image
+import raster_engrave, raster_sim
+
+# name, params on top of raster_w=1
+JOBS = [
+    ('default', {}),
+    ('rle', dict(rle=True, bits_per_dot=3)),
+    ('double_buffer', dict(double_buffer=True, bidirectional_raster=True)),
+    # the short lead out ends right after the last dot
+    ('compensated', dict(lead_in_mode='compensated', bidirectional_raster=True)),
+    # big dots and a short lead out in mm
+    ('metric', dict(is_metric=True, raster_w=25, XDPI=6.215, YDPI=6.215)),
+    ('step_and_repeat', dict(repeat_grid=(3, 2), repeat_pitch=(1.2, 1.6))),
+    ('step_and_repeat_split', dict(repeat_grid=(3, 1), repeat_pitch=(1.5, 0), air_gap_min=0.2)),
+    ('sidecar', dict(sidecar=True, data_pins=4)),
+    ('stream', dict(stream=True, bidirectional_raster=True)),
+]
+
+
+def check_job(image_name, name, params, directory, ini_file):
+    """Generate and simulate one job, returns a list of what went wrong"""
+    gcode = os.path.join(directory, name + '.ngc')
+    params = dict(dict(raster_w=1), **params)
+    params['actual_image'] = os.path.join(directory, name + '.png')
+    for data in ('sidecar', 'stream'):
+        if params.get(data) is True:
+            params[data] = os.path.splitext(gcode)[0] + ('.lrb' if data == 'sidecar' else '.stream')
+    with open(gcode, 'w') as out:
+        raster_engrave.write_gcode(raster_engrave.generate_raster(image_name, params), out)
+
+    burnt, sim = raster_sim.simulate(gcode, ini_file)
+    expected = raster_sim.image_levels(Image.open(params['actual_image']), sim.bits_per_dot)
+    faults = []
+    if expected.shape != burnt.shape:
+        faults.append('actual image is %ux%u, the raster is %ux%u' % (expected.shape[::-1] + burnt.shape[::-1]))
+    else:
+        missing, extra, level = raster_sim.compare_dots(burnt, expected)
+        if missing or extra or level:
+            faults.append('%u dots missing, %u extra, %u at the wrong level' % (missing, extra, level))
+    if sim.counts['wrong direction']:
+        faults.append('%u lines stopped moving the wrong way' % sim.counts['wrong direction'])
+    if not sim.counts['lines']:
+        faults.append('no lines burnt')
+    return faults
+
+def main(argv):
+    import argparse
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Check raster jobs burn their actual image in simulation')
+    parser.add_argument('image', nargs='?', default=os.path.join(here, 'example_gcode', 'Mona_Lisa.png'),
+                        help='image to engrave, default example_gcode/Mona_Lisa.png')
+    parser.add_argument('-j', '--job', action='append', choices=[name for name, params in JOBS],
+                        help='only check this job, default all of them')
+    parser.add_argument('-k', '--keep', metavar='DIR', help='leave the gcode and images in DIR')
+    parser.add_argument('--ini', default=os.path.join(here, '40WLaser.ini'),
+                        help='LinuxCNC INI with the units, scales and limits of X and Y')
+    args = parser.parse_args(argv)
+
+    directory = args.keep or tempfile.mkdtemp(prefix='raster_check')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    failed = 0
+    try:
+        for name, params in JOBS:
+            if args.job and name not in args.job:
+                continue
+            start = time.time()
+            faults = check_job(args.image, name, params, directory, args.ini)
+            print('%-24s %s %0.1f s' % (name, 'FAIL' if faults else 'ok', time.time() - start))
+            for fault in faults:
+                print('    ' + fault)
+            failed += bool(faults)
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Grayscale to 1 bit dithering for raster_engrave.py
+#
+# Error diffusion is sequential in both x and y, but a pixel only depends
+# on pixels to its left and in the rows above.  Processing the image in
+# skewed diagonals (all pixels where x + skew*y == t) lets every pixel in a
+# diagonal be handled at once with numpy.  The skew is picked so that no two
+# pixels of a diagonal push error into the same place, which lets the error
+# be spread with one fancy indexed add per diagonal.
+
+import numpy
+
+# (dy, dx, weight) of where the error of a pixel goes, and the divisor
+KERNELS = {
+    'floyd-steinberg': ([(0,1,7), (1,-1,3), (1,0,5), (1,1,1)], 16),
+    'jarvis': ([(0,1,7), (0,2,5),
+                (1,-2,3), (1,-1,5), (1,0,7), (1,1,5), (1,2,3),
+                (2,-2,1), (2,-1,3), (2,0,5), (2,1,3), (2,2,1)], 48),
+    'stucki': ([(0,1,8), (0,2,4),
+                (1,-2,2), (1,-1,4), (1,0,8), (1,1,4), (1,2,2),
+                (2,-2,1), (2,-1,2), (2,0,4), (2,1,2), (2,2,1)], 42),
+}
+
+ORDERED = ('bayer', 'blue-noise')
+
+METHODS = ('pil', 'threshold') + tuple(sorted(KERNELS)) + ORDERED
+
+# error spreads at most this far left, right and down
+PAD = 2
+
+
+def gamma_correct(gray, gamma):
+    """Return gray (uint8) as float32 with a gamma curve applied"""
+    lut = numpy.arange(256, dtype=numpy.float64) / 255.0
+    lut = (255.0 * lut ** gamma).astype(numpy.float32)
+    return lut[gray]
+
+def diagonal_skew(kernel):
+    """Smallest skew where no two pixels of a diagonal share a target"""
+    taps = kernel[0]
+    spread = max([dx for dy, dx, w in taps]) - min([dx for dy, dx, w in taps])
+    # targets of pixels k rows apart collide when their dx differ by skew*k
+    skew = spread + 1
+    # and everything a pixel feeds has to come on a later diagonal
+    for dy, dx, w in taps:
+        while dy > 0 and dx + skew*dy <= 0:
+            skew += 1
+    return skew
+
+def error_diffusion(gray, method, threshold=128, carry=None):
+    """Dither a float32 strip with error diffusion
+
+    carry is the error pushed below the previous strip (PAD rows), so an
+    image can be dithered strip by strip with the same result as in one go.
+    Returns (dots, carry), dots is True where the pixel is dark.
+    """
+    (h, w) = gray.shape
+    kernel = KERNELS[method]
+    skew = diagonal_skew(kernel)
+    stride = w + 2*PAD
+
+    # image plus accumulated error, padded so taps never need clipping
+    buf = numpy.zeros((h + PAD, stride), dtype=numpy.float32)
+    buf[:h, PAD:PAD+w] = gray
+    if carry is not None:
+        buf[:PAD, PAD:PAD+w] += carry
+    buf = buf.ravel()
+    white = numpy.zeros(buf.shape, dtype=bool)
+
+    offsets = numpy.array([dy*stride + dx for dy, dx, weight in kernel[0]])
+    weights = numpy.array([weight for dy, dx, weight in kernel[0]], dtype=numpy.float32)
+    weights /= kernel[1]
+
+    # flat index of the pixel (y, x + skew*y) is base[y] + x
+    base = numpy.arange(h) * (stride - skew) + PAD
+    for t in xrange(w + skew*(h-1)):
+        y_lo = max(0, (t - w + skew) // skew)
+        y_hi = min(h - 1, t // skew)
+        index = base[y_lo:y_hi+1] + t
+        value = buf[index]
+        on = value >= threshold
+        white[index] = on
+        error = value - 255*on
+        buf[(index[:,None] + offsets).ravel()] += (error[:,None] * weights).ravel()
+
+    white = white.reshape(h + PAD, stride)
+    buf = buf.reshape(h + PAD, stride)
+    return ~white[:h, PAD:PAD+w], buf[h:, PAD:PAD+w].copy()
+
+def bayer_matrix(n=8):
+    """Return the n x n (power of 2) Bayer index matrix"""
+    m = numpy.zeros((1,1), dtype=int)
+    while len(m) < n:
+        m = numpy.bmat([[4*m, 4*m+2], [4*m+3, 4*m+1]]).A
+    return m
+
+_blue_noise = {}
+
+def blue_noise_matrix(size=64, sigma=1.5, seed=1):
+    """Return a size x size blue noise rank matrix using void and cluster
+
+    The matrix is built once and cached, it takes a fraction of a second.
+    """
+    key = (size, sigma, seed)
+    if key in _blue_noise:
+        return _blue_noise[key]
+
+    n = size*size
+    d = numpy.minimum(numpy.arange(size), size - numpy.arange(size))
+    gauss = numpy.exp(-(d[:,None]**2 + d[None,:]**2) / (2.0*sigma*sigma))
+
+    def splat(index):
+        # energy a single dot adds, wrapping around the tile
+        (i, j) = divmod(index, size)
+        return numpy.roll(numpy.roll(gauss, i, 0), j, 1).ravel()
+
+    pattern = numpy.random.RandomState(seed).rand(n) < 0.1
+    energy = numpy.real(numpy.fft.ifft2(numpy.fft.fft2(pattern.reshape(size,size)) *
+                                        numpy.fft.fft2(gauss))).ravel()
+
+    # move dots from the tightest cluster to the largest void until stable
+    for i in xrange(n):
+        cluster = numpy.where(pattern, energy, -numpy.inf).argmax()
+        pattern[cluster] = False
+        energy -= splat(cluster)
+        void = numpy.where(pattern, numpy.inf, energy).argmin()
+        pattern[void] = True
+        energy += splat(void)
+        if void == cluster:
+            break
+
+    ranks = numpy.zeros(n, dtype=int)
+    ones = int(pattern.sum())
+
+    # rank the initial dots by removing the tightest clusters first
+    remaining = pattern.copy()
+    remaining_energy = energy.copy()
+    for rank in xrange(ones-1, -1, -1):
+        cluster = numpy.where(remaining, remaining_energy, -numpy.inf).argmax()
+        remaining[cluster] = False
+        remaining_energy -= splat(cluster)
+        ranks[cluster] = rank
+
+    # then fill the largest voids
+    for rank in xrange(ones, n):
+        void = numpy.where(pattern, numpy.inf, energy).argmin()
+        pattern[void] = True
+        energy += splat(void)
+        ranks[void] = rank
+
+    _blue_noise[key] = ranks.reshape(size, size)
+    return _blue_noise[key]
+
+def ordered_dither(gray, method, threshold=128, y0=0):
+    """Dither a float32 strip starting at image row y0 with a threshold map"""
+    if method == 'bayer':
+        ranks = bayer_matrix()
+    else:
+        ranks = blue_noise_matrix()
+    size = len(ranks)
+    levels = (ranks + 0.5) * (255.0 / (size*size)) + (threshold - 128)
+
+    (h, w) = gray.shape
+    rows = numpy.arange(y0, y0 + h) % size
+    cols = numpy.arange(w) % size
+    return gray < levels[rows[:,None], cols[None,:]]
+
+def quantize(gray, bits, gamma=1.0):
+    """Turn a uint8 grayscale image into power levels of bits bits
+
+    Black is the highest level, white is 0 and does not burn.
+    """
+    levels = (1 << bits) - 1
+    if gamma != 1.0:
+        gray = gamma_correct(gray, gamma)
+    dark = 255.0 - gray
+    return numpy.floor(dark * (levels / 255.0) + 0.5).astype(numpy.uint8)
+
+def dither(gray, method, threshold=128, gamma=1.0, carry=None, y0=0):
+    """Turn a uint8 grayscale strip into dots to burn
+
+    gray is a 2d array, y0 is its first row in the whole image and carry
+    the error diffusion state returned by the strip above it.  Returns
+    (dots, carry) where dots is True where the laser fires.
+    """
+    if gamma != 1.0:
+        gray = gamma_correct(gray, gamma)
+    else:
+        gray = gray.astype(numpy.float32)
+
+    if method == 'threshold':
+        return gray < threshold, None
+    if method in KERNELS:
+        return error_diffusion(gray, method, threshold, carry)
+    if method in ORDERED:
+        return ordered_dither(gray, method, threshold, y0), None
+    raise ValueError('unknown dither=%s, use one of %s' % (method, ', '.join(METHODS)))
@@ -2,263 +2,1857 @@
 
 # shadowbox dpi=45 speed=300 power=80 on_time=1.5
 
-# user defined parameters
-SPEED = 600
-ACCEL = 270
-laser_power = 30
-laser_on_time = 0.3
-air_assist = True
-bidirectional_raster = False
-is_metric = False
-origin_x = 0
-origin_y = 0
-# center, <top|middle|bottom><left|center|right>
-origin_loc = 'topleft'
-# for mirroring
-mirror_x = False
-mirror_y = False
-# output raster Falsesize
-keep_aspect_ratio = True
-raster_w = -1
-raster_h = -1
-# raster dpi
-XDPI = 200
-YDPI = 200
-
-
-import os, sys, time, glob
-from math import ceil, floor
-from subprocess import *
-from itertools import *
+import os, sys, re, struct, zlib
+from math import ceil, floor, sqrt, hypot
+from itertools import izip, imap
+from collections import deque
 from PIL import Image
-from raster_gui import *
-
-
-if ( len(sys.argv) > 1 and os.path.exists(sys.argv[1]) ):
-    image_name = sys.argv[1]
-else:
-    image_name = image_not_found()
-
-print('%')
-print '(image = %s)' % image_name
-
-image = Image.open(image_name)
-
-(img_w,img_h) = image.size
-print('(image size w=%u,h=%u)' % (img_w,img_h))
-
-# system parameters
-output_optional_border = False
-distribute_bits_in_floats = False
-MAX_BPF = 53
-
-# calc lead in + 100% fudge
-leadIn = (1.0*SPEED*SPEED/3600)/ACCEL
-
-print '(raster requested size w=%f, h=%f)' % (raster_w,raster_h)
-
-# adjust to aspect ratio
-raster_w_scaled_to_h = raster_h*float(img_w)/img_h
-raster_h_scaled_to_w = raster_w*float(img_h)/img_w
-
-if raster_w < 0 and raster_h < 0:
-    # set size to be exactly input image
-    raster_w = img_w/float(XDPI)
-    raster_h = img_h/float(YDPI)
-    pix_w = img_w
-    pix_h = img_h
-    W = raster_w
-    H = raster_h
-else:
-    if raster_w < 0:
-        raster_w = raster_w_scaled_to_h
-    elif raster_h < 0:
-        raster_h = raster_h_scaled_to_w
-    elif keep_aspect_ratio:
-        if raster_w < raster_w_scaled_to_h:
-            raster_h = raster_h_scaled_to_w
-            print '(keep aspect ratio scaling h down to %f)' % (raster_h)
-        elif raster_h < raster_h_scaled_to_w:
+import numpy
+import raster_dither, raster_cache
+
+# user defined parameters, the command line can override any of
+# them with -p name=value
+default_params = dict(
+    SPEED = 600,
+    ACCEL = 270,
+    laser_power = 30,
+    laser_on_time = 0.3,
+    air_assist = True,
+    bidirectional_raster = False,
+    # pick each row's direction to minimise rapids, implies bidirectional
+    plan_directions = False,
+    is_metric = False,
+    origin_x = 0,
+    origin_y = 0,
+    # center, <top|middle|bottom><left|center|right>
+    origin_loc = 'topleft',
+    # for mirroring
+    mirror_x = False,
+    mirror_y = False,
+    # output raster size
+    keep_aspect_ratio = True,
+    raster_w = -1,
+    raster_h = -1,
+    # raster dpi
+    XDPI = 200,
+    YDPI = 200,
+    # pil, threshold, floyd-steinberg, jarvis, stucki, bayer or blue-noise
+    dither = 'pil',
+    # gray level (0-255) dots start burning at and gamma applied before
+    dither_threshold = 128,
+    gamma = 1.0,
+    # power levels per dot as 2^bits_per_dot-1 pulse widths, 1 is on/off
+    bits_per_dot = 1,
+    # split a row into separate raster lines at long blank gaps
+    split_air_gaps = False,
+    # shortest gap to split at, -1 works it out from the speeds below
+    air_gap_min = -1,
+    # G0 speed (units/min) and acceleration, -1 uses SPEED and ACCEL
+    RAPID_SPEED = -1,
+    RAPID_ACCEL = -1,
+    # time spent setting up each raster line (data load, M1), seconds,
+    # the time estimate takes it as the M1 and adds a servo period per M68
+    line_overhead = 0.05,
+    # full leads in to SPEED, compensated has laserraster scale the pulses
+    # to the measured speed and only leads in to compensated_speed*SPEED
+    lead_in_mode = 'full',
+    compensated_speed = 0.5,
+    # hold the laser on across runs of full power dots instead of pulsing
+    # each one, and across gaps shorter than min_off_gap (inches or mm)
+    cw_mode = False,
+    min_off_gap = 0,
+    # axis the rows sweep along, x, y or auto to pick the quicker one
+    # from the MAX_VELOCITY and MAX_ACCELERATION of each axis in ini_file
+    raster_axis = 'x',
+    # move the dots of forward and reverse rows along the sweep (inches or
+    # mm, + is towards + on the axis) so they line up, on top of laserraster's
+    # forward-offset and reverse-offset params from the INI for this job only
+    forward_offset = 0,
+    reverse_offset = 0,
+    # the LinuxCNC INI, '' uses 40WLaser.ini next to this script
+    ini_file = '',
+    # step and repeat, copies of the image in a grid of (columns, rows)
+    # repeat_pitch (x, y) apart, 0 butts them together, or at the (x, y)
+    # offsets from the first copy in repeat_at.  The origin places the
+    # first copy, the grid goes right and down from it
+    repeat_grid = (1, 1),
+    repeat_pitch = (0, 0),
+    repeat_at = (),
+
+    # system parameters
+    output_optional_border = False,
+    distribute_bits_in_floats = False,
+    MAX_BPF = 53,
+    # words loaded per data index, 1 to 4, words 2 on go out on M68 E3-E5
+    # which have to be netted to laserraster data-2 on
+    data_pins = 1,
+    # send rows as runs of dots instead of a bitmap when that is fewer words
+    rle = False,
+    # load each raster line while the one before it burns
+    double_buffer = False,
+    # write the data words to a .lrb file and load each line with one M150
+    # through rasterload.py instead of o100 calls, True names the file after
+    # -o, which is where rasterload looks for it, can't double buffer
+    sidecar = False,
+    # write the data words to a .stream file for halstreamer, which laserraster
+    # takes from the streamer fifo as each line burns, True names the file
+    # after -o, can't double buffer or go with sidecar
+    stream = False,
+    # shortest piece of G1 that carries data for the next line, -1 uses
+    # the lead in, the distance needed to get up to speed and stop again
+    preload_min_move = -1,
+    # worker processes encoding rows, 1 encodes serially, 0 uses every cpu
+    processes = 1,
+    # rows handed to a worker at a time
+    band_rows = 64,
+    # scale and dither the image this many rows at a time to bound memory,
+    # 0 does the whole image at once
+    strip_rows = 0,
+    # only count the data calls rather than write them, the gcode is
+    # just good for estimate_time()
+    estimate_only = False,
+    # save the 1 bit image that is engraved, None to skip
+    actual_image = 'actual.png',
+    # keep the scaled dots, encoded rows and gcode of jobs here to skip
+    # the work next time, '' for no cache, $RASTER_ENGRAVE_CACHE by default
+    cache_dir = os.environ.get('RASTER_ENGRAVE_CACHE', ''),
+    # megabytes the cache holds before the least recently used go
+    cache_size = 500,
+)
+
+# params that change how the gcode is made but not what it is
+UNCACHED_PARAMS = ('processes', 'band_rows', 'actual_image', 'cache_dir', 'cache_size')
+
+
+def repeats(p):
+    """True when p burns more than one copy of the image"""
+    return len(p['repeat_at']) > 1 or tuple(p['repeat_grid']) != (1, 1)
+
+def image_dots(image):
+    """Return a 2d bool array of a 1 bit image, True where a dot burns"""
+    (w,h) = image.size
+    # mode '1' raw data is 8 pixels per byte, msb first, rows byte padded
+    packed = numpy.frombuffer(image.tobytes(), dtype=numpy.uint8)
+    packed = packed.reshape(h, -1)
+    return numpy.unpackbits(packed, axis=1)[:,:w] == 0
+
+def row_extents(dots):
+    """Return arrays of the first and last dot of every row, -1 if blank"""
+    if dots.dtype != bool:
+        dots = dots != 0
+    blank = ~dots.any(axis=1)
+    firsts = dots.argmax(axis=1)
+    lasts = dots.shape[1] - 1 - dots[:,::-1].argmax(axis=1)
+    firsts[blank] = -1
+    lasts[blank] = -1
+    return firsts, lasts
+
+def row_extent(row):
+    """Return (first,last) index of the dots in a row, (-1,-1) if blank"""
+    if row.dtype != bool:
+        row = row != 0
+    if not row.any():
+        return (-1,-1)
+    return (int(row.argmax()), int(len(row) - 1 - row[::-1].argmax()))
+
+def pack_bits(bits, bpf, bits_per_dot=1):
+    """Pack dots into words of bpf dots, lsb first
+
+    bits is a bool array, or an array of power levels for more than one
+    bit per dot.
+    """
+    count = (len(bits) + bpf - 1) // bpf
+    padded = numpy.zeros(count * bpf, dtype=numpy.uint64)
+    padded[:len(bits)] = bits
+    shifts = numpy.arange(bpf, dtype=numpy.uint64) * numpy.uint64(bits_per_dot)
+    weights = numpy.left_shift(numpy.uint64(1), shifts)
+    return padded.reshape(count, bpf).dot(weights)
+
+
+def lead_in(p):
+    """Distance needed to get up to raster speed"""
+    # calc lead in + 100% fudge
+    distance = (1.0*p['SPEED']*p['SPEED']/3600)/p['ACCEL']
+    if p['lead_in_mode'] == 'compensated':
+        # the distance goes with the square of the speed reached
+        distance *= p['compensated_speed']**2
+    return distance
+
+def move_time(distance, speed, accel):
+    """Time in seconds of a stop to stop move with a trapezoid profile
+
+    speed is in units/min like F, accel in units/s^2.
+    """
+    v = speed/60.0
+    distance = abs(distance)
+    if distance < v*v/accel:
+        # never gets up to speed
+        return 2*sqrt(distance/accel)
+    return distance/v + v/accel
+
+def rapid_speed(p):
+    """Return the (speed, accel) used for G0 moves"""
+    speed = p['RAPID_SPEED'] if p['RAPID_SPEED'] > 0 else p['SPEED']
+    accel = p['RAPID_ACCEL'] if p['RAPID_ACCEL'] > 0 else p['ACCEL']
+    return speed, accel
+
+def air_gap_dots(p, row_len):
+    """Shortest run of blank dots a row is split at, 0 to never split"""
+    # copies on a row are split apart where that pays, so they can share data
+    if not p['split_air_gaps'] and not repeats(p):
+        return 0
+    XDPI = p['XDPI']
+    if p['air_gap_min'] >= 0:
+        return max(1, int(ceil(p['air_gap_min']*XDPI)))
+
+    # sweeping the gap at raster speed against a lead out, a rapid to the
+    # next lead in and accelerating up to speed again.  getting to speed
+    # over the lead in takes v/a/2 longer than moving it at full speed,
+    # and the same again slowing down at the end of the lead out.
+    leadIn = lead_in(p)
+    v = p['SPEED']/60.0
+    (rapid, rapid_accel) = rapid_speed(p)
+    gaps = numpy.arange(row_len+1) / float(XDPI)
+    sweep = gaps / v
+    split = 2*leadIn/v + v/p['ACCEL'] + p['line_overhead']
+    split = split + numpy.array([move_time(g - 2*leadIn, rapid, rapid_accel) for g in gaps])
+    # lead out and lead in would overlap
+    split[gaps < 2*leadIn] = numpy.inf
+    pays = numpy.flatnonzero(split < sweep)
+    if not len(pays):
+        return 0
+    return int(pays[0])
+
+def read_ini(p):
+    """Return the LinuxCNC INI and the scale from its units to the gcode's"""
+    from ConfigParser import RawConfigParser
+    ini_file = p['ini_file'] or os.path.join(os.path.dirname(os.path.abspath(__file__)), '40WLaser.ini')
+    ini = RawConfigParser()
+    ini.read(ini_file)
+
+    scale = 1.0
+    if ini.has_option('TRAJ', 'LINEAR_UNITS'):
+        machine_is_metric = ini.get('TRAJ', 'LINEAR_UNITS').strip() == 'mm'
+        if machine_is_metric and not p['is_metric']:
+            scale = 1/25.4
+        elif not machine_is_metric and p['is_metric']:
+            scale = 25.4
+    return ini, scale
+
+def axis_limits(p):
+    """Return {axis: (speed, accel)} for x and y from the INI
+
+    The INI has the MAX_VELOCITY (units/s) and MAX_ACCELERATION of each
+    axis in machine units, they are returned as speed in units/min like F
+    and accel in units/s^2, in inches or mm as the gcode is.  An axis
+    without limits in the INI gets SPEED and ACCEL.
+    """
+    ini, scale = read_ini(p)
+    limits = {}
+    for axis, section in (('x', 'AXIS_0'), ('y', 'AXIS_1')):
+        speed, accel = p['SPEED'], p['ACCEL']
+        if ini.has_option(section, 'MAX_VELOCITY'):
+            speed = float(ini.get(section, 'MAX_VELOCITY')) * scale * 60
+        if ini.has_option(section, 'MAX_ACCELERATION'):
+            accel = float(ini.get(section, 'MAX_ACCELERATION')) * scale
+        limits[axis] = (speed, accel)
+    return limits
+
+def raster_time(pix_w, pix_h, dpi, speed, accel, p):
+    """Rough seconds to sweep pix_h full rows of pix_w dots at dpi"""
+    sweep = dict(p, SPEED=speed, ACCEL=accel)
+    length = pix_w/float(dpi) + 2*lead_in(sweep)
+    return pix_h * (move_time(length, speed, accel) + p['line_overhead'])
+
+def choose_raster_axis(layout, p):
+    """Return the axis, x or y, that rasters quicker and gcode comments
+
+    Each axis sweeps at SPEED and ACCEL or as fast as the INI lets it, so
+    the axis with fewer rows or the shorter lead in wins.
+    """
+    limits = axis_limits(p)
+    rows = {'x': (layout['pix_w'], layout['pix_h'], p['XDPI']),
+            'y': (layout['pix_h'], layout['pix_w'], p['YDPI'])}
+    times = {}
+    for axis in ('x', 'y'):
+        (speed, accel) = limits[axis]
+        times[axis] = raster_time(rows[axis][0], rows[axis][1], rows[axis][2],
+                                  min(p['SPEED'], speed), min(p['ACCEL'], accel), p)
+    axis = 'y' if times['y'] < times['x'] else 'x'
+    notes = ['(raster along x about %0.0f s, along y about %0.0f s, using %s)' % (times['x'], times['y'], axis)]
+    return axis, notes
+
+def sweep_frame(layout, p):
+    """Return the layout and params of a raster that sweeps along Y
+
+    The rest of the generator sweeps rows along X and steps down Y.  A Y
+    raster is done in a frame with the axes swapped, the gcode letters
+    swapped back, where the rows are the image columns from the right and
+    the dots run up the image.  frame_dots() turns the dots round to
+    match.
+    """
+    frame = dict(layout)
+    frame['pix_w'], frame['pix_h'] = layout['pix_h'], layout['pix_w']
+    frame['W'], frame['H'] = layout['H'], layout['W']
+    frame['X'] = layout['Y'] - layout['H']
+    frame['Y'] = layout['X'] + layout['W']
+    frame['axes'] = ('Y', 'X')
+    frame_p = dict(p, XDPI=p['YDPI'], YDPI=p['XDPI'], raster_axis='y')
+    return frame, frame_p
+
+def frame_dots(dots):
+    """Turn image dots into the rows of a sweep_frame() raster"""
+    return numpy.ascontiguousarray(dots[::-1, ::-1].T)
+
+def raster_layout(img_w, img_h, p):
+    """Work out the pixel size and placement of the raster
+
+    Returns a dict with pix_w, pix_h, W, H and the upper left corner X, Y
+    plus a list of gcode comments describing the result.
+    """
+    XDPI = p['XDPI']
+    YDPI = p['YDPI']
+    raster_w = p['raster_w']
+    raster_h = p['raster_h']
+    origin_x = p['origin_x']
+    origin_y = p['origin_y']
+    origin_loc = p['origin_loc']
+
+    notes = ['(raster requested size w=%f, h=%f)' % (raster_w,raster_h)]
+
+    # adjust to aspect ratio
+    raster_w_scaled_to_h = raster_h*float(img_w)/img_h
+    raster_h_scaled_to_w = raster_w*float(img_h)/img_w
+
+    if raster_w < 0 and raster_h < 0:
+        # set size to be exactly input image
+        raster_w = img_w/float(XDPI)
+        raster_h = img_h/float(YDPI)
+        pix_w = img_w
+        pix_h = img_h
+        W = raster_w
+        H = raster_h
+    else:
+        if raster_w < 0:
             raster_w = raster_w_scaled_to_h
-            print '(keep aspect ratio scaling w down to %f)' % (raster_w)
-
-    # calc image raster size
-    pix_w = int(raster_w * XDPI)
-    pix_h = int(raster_h * YDPI)
-    W = float(pix_w) / XDPI
-    H = float(pix_h) / YDPI
-
-# handle origin offsetting
-if ( origin_loc == 'center' ):
-    X = origin_x - W/2.0
-    Y = origin_y + H/2.0
-else:
-    if ( 'top' in origin_loc ):
-        Y = origin_y
-    elif ( 'bottom' in origin_loc ):
-        Y = origin_y + H
-    elif ( 'middle' in origin_loc ):
+        elif raster_h < 0:
+            raster_h = raster_h_scaled_to_w
+        elif p['keep_aspect_ratio']:
+            if raster_w < raster_w_scaled_to_h:
+                raster_h = raster_h_scaled_to_w
+                notes.append('(keep aspect ratio scaling h down to %f)' % (raster_h))
+            elif raster_h < raster_h_scaled_to_w:
+                raster_w = raster_w_scaled_to_h
+                notes.append('(keep aspect ratio scaling w down to %f)' % (raster_w))
+
+        # calc image raster size
+        pix_w = int(raster_w * XDPI)
+        pix_h = int(raster_h * YDPI)
+        W = float(pix_w) / XDPI
+        H = float(pix_h) / YDPI
+
+    # handle origin offsetting
+    if ( origin_loc == 'center' ):
+        X = origin_x - W/2.0
         Y = origin_y + H/2.0
     else:
-        print('unknown origin_loc='+origin_loc)
-        sys.exit()
+        if ( 'top' in origin_loc ):
+            Y = origin_y
+        elif ( 'bottom' in origin_loc ):
+            Y = origin_y + H
+        elif ( 'middle' in origin_loc ):
+            Y = origin_y + H/2.0
+        else:
+            raise ValueError('unknown origin_loc='+origin_loc)
 
-    if ( 'left' in origin_loc ):
-        X = origin_x
-    elif ( 'center' in origin_loc ):
-        X = origin_x - W/2.0
-    elif ( 'right' in origin_loc ):
-        X = origin_x - W
+        if ( 'left' in origin_loc ):
+            X = origin_x
+        elif ( 'center' in origin_loc ):
+            X = origin_x - W/2.0
+        elif ( 'right' in origin_loc ):
+            X = origin_x - W
+        else:
+            raise ValueError('unknown origin_loc='+origin_loc)
+
+    notes.append('(raster upper right corner x=%f,y=%f)' % (X,Y))
+    notes.append('(raster calculated size w=%f,h=%f)' % (W,H))
+
+    # gcode letters of the axis rows sweep along and the one they step down
+    return dict(pix_w=pix_w, pix_h=pix_h, W=W, H=H, X=X, Y=Y, axes=('X', 'Y'), notes=notes)
+
+def repeat_layout(layout, p):
+    """Work out the placement of the step and repeat copies of a raster
+
+    Copies land on whole dots from the first, the one raster_layout()
+    placed, so every copy burns the same dots.  Returns layout itself for
+    a single copy, otherwise a layout of the whole batch with copies, the
+    dot offset of each copy from its upper left corner.
+    """
+    if not repeats(p):
+        return layout
+    XDPI = float(p['XDPI'])
+    YDPI = float(p['YDPI'])
+    if p['repeat_at']:
+        offsets = [(float(x), float(y)) for x, y in p['repeat_at']]
     else:
-        print('unknown origin_loc='+origin_loc)
-        sys.exit()
-
-print '(raster upper right corner x=%f,y=%f)' % (X,Y)
-print '(raster calculated size w=%f,h=%f)' % (W,H)
-
-if img_w != pix_w or img_h != pix_h:
-    print '(rescaling image to %u,%u pixels)' % (pix_w, pix_h)
-    image = image.resize((pix_w, pix_h), Image.BICUBIC)
-else:
-    print '(keeping image size %u,%u pixels)' % (pix_w, pix_h)
-image = image.convert('1')
-
-if mirror_x:
-    print '(flip image left to right)'
-    image = image.transpose(Image.FLIP_LEFT_RIGHT)
-if mirror_y:
-    print '(flip image top to bottom)'
-    image = image.transpose(Image.FLIP_TOP_BOTTOM)
-
-image.save('actual.png')
-
-pix = list(image.getdata())
-
-# gcode header
-if is_metric:
-    print('G21')
-else:
-    print('G20')
-print('M63 P0 (turn off laser dout)')
-print('G0 Z0 (turn off magic z)')
-print('G64 P0.0001 Q0.0001 (minimal path blending)')
-print('M68 E0 Q%0.3f (set laser power level)' % laser_power)
-print('M3 S1 (master laser power on)')
-if air_assist:
-    print('M7 (air assist on)')
-print('#<raster_speed> = %0.3f' % SPEED)
-print('F[#<raster_speed>]')
-
-# gcode skip lines that show raster image run box
-if output_optional_border:
-    print('/ G0 X%0.4f Y%0.4f' % (X,Y))
-    print('/ G1 X%0.4f Y%0.4f' % (X+W,Y))
-    print('/ G1 X%0.4f Y%0.4f' % (X+W,Y-H))
-    print('/ G1 X%0.4f Y%0.4f' % (X,Y-H))
-    print('/ G1 X%0.4f Y%0.4f' % (X,Y))
-    print('/ M2')
-
-print('o100 sub')
-print('  M68 E2 Q[#2]')
-print('  M68 E1 Q[#1]')
-print('o100 endsub')
-
-forward = True
-first_output = True
-
-for y in xrange(0,pix_h):
-    offset_y = Y - 1/float(YDPI)/2 - float(y)/YDPI
-
-    row = pix[y * pix_w:(y + 1) * pix_w]
-
-    if not forward:
-        row.reverse()
-
-    first_non_zero = -1
-    last_non_zero = -1
-    for index, pixel in enumerate(row):
-        if (pixel <= 127):
-            if (first_non_zero == -1):
-                first_non_zero = index
-            last_non_zero = index
+        (columns, rows) = p['repeat_grid']
+        pitch_x = p['repeat_pitch'][0] or layout['W']
+        pitch_y = p['repeat_pitch'][1] or layout['H']
+        offsets = [(c*pitch_x, -r*pitch_y) for r in xrange(rows) for c in xrange(columns)]
+
+    # dot columns right and rows down
+    dots = [(int(floor(x*XDPI + 0.5)), int(floor(-y*YDPI + 0.5))) for x, y in offsets]
+    moved = max(max(abs(c/XDPI - x), abs(-r/YDPI - y)) for (c, r), (x, y) in izip(dots, offsets))
+    left = min(c for c, r in dots)
+    top = min(r for c, r in dots)
+
+    batch = dict(layout)
+    batch['copies'] = [(c - left, r - top) for c, r in dots]
+    batch['pix_w'] = max(c for c, r in batch['copies']) + layout['pix_w']
+    batch['pix_h'] = max(r for c, r in batch['copies']) + layout['pix_h']
+    batch['W'] = batch['pix_w'] / XDPI
+    batch['H'] = batch['pix_h'] / YDPI
+    batch['X'] = layout['X'] + left / XDPI
+    batch['Y'] = layout['Y'] - top / YDPI
+    batch['notes'] = ['(step and repeat %u copies, batch %u,%u pixels, upper left x=%f,y=%f, size w=%f,h=%f)' % (
+        len(dots), batch['pix_w'], batch['pix_h'], batch['X'], batch['Y'], batch['W'], batch['H'])]
+    if moved > 1e-6:
+        batch['notes'].append('(copies moved up to %f to land on whole dots)' % moved)
+    return batch
+
+def repeat_dots(dots, batch):
+    """Place the dots of one copy at every copy of a batch"""
+    (h, w) = dots.shape
+    placed = numpy.zeros((batch['pix_h'], batch['pix_w']), dtype=dots.dtype)
+    for c, r in batch['copies']:
+        # overlapping copies burn the darker dot
+        area = placed[r:r+h, c:c+w]
+        numpy.maximum(area, dots, out=area)
+    return placed
+
+def level_gray(levels, bits_per_dot):
+    """Return power levels as uint8 gray, black being the highest level"""
+    return (255 - levels * (255.0 / ((1<<bits_per_dot)-1))).astype(numpy.uint8)
+
+def dots_image(dots, bits_per_dot=1):
+    """Return a PIL image of a dots array, black where a dot burns
+
+    Power levels give a grayscale image, on/off dots a 1 bit one.
+    """
+    if dots.dtype != bool:
+        return Image.fromarray(level_gray(dots, bits_per_dot))
+    return Image.fromarray(numpy.where(dots, 0, 255).astype(numpy.uint8)).convert('1', dither=Image.NONE)
+
+class StripPngWriter(object):
+    """Write a grayscale PNG a strip of rows at a time
+
+    dots arrays are written 1 bit deep, power levels 8 bits deep, without
+    ever holding more than one strip of the image.
+    """
+    def __init__(self, name, width, height, bits_per_dot=1):
+        self.out = open(name, 'wb')
+        self.bits_per_dot = bits_per_dot
+        self.compress = zlib.compressobj()
+        self.out.write('\x89PNG\r\n\x1a\n')
+        depth = 1 if bits_per_dot == 1 else 8
+        self.chunk('IHDR', struct.pack('>IIBBBBB', width, height, depth, 0, 0, 0, 0))
+
+    def chunk(self, kind, data):
+        self.out.write(struct.pack('>I', len(data)) + kind + data)
+        self.out.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write_rows(self, dots):
+        if dots.dtype == bool:
+            # 1 is white
+            rows = numpy.packbits(~dots, axis=1)
+        else:
+            rows = level_gray(dots, self.bits_per_dot)
+        # every row starts with filter type 0
+        rows = numpy.hstack([numpy.zeros((len(rows),1), dtype=numpy.uint8), rows])
+        data = self.compress.compress(rows.tobytes())
+        if data:
+            self.chunk('IDAT', data)
+
+    def close(self):
+        self.chunk('IDAT', self.compress.flush())
+        self.chunk('IEND', '')
+        self.out.close()
+
+def prepare_image(image, layout, p):
+    """Scale, dither and mirror an image for engraving
+
+    Returns a 2d bool array that is True where a dot burns and a list of
+    gcode comments.
+    """
+    pix_w = layout['pix_w']
+    pix_h = layout['pix_h']
+    method = p['dither']
+    notes = []
+
+    if p['bits_per_dot'] > 1:
+        method = 'levels'
+    if method != 'pil':
+        # dither the grayscale at the engraving resolution
+        image = image.convert('L')
+    if image.size != (pix_w, pix_h):
+        notes.append('(rescaling image to %u,%u pixels)' % (pix_w, pix_h))
+        image = image.resize((pix_w, pix_h), Image.BICUBIC)
+    else:
+        notes.append('(keeping image size %u,%u pixels)' % (pix_w, pix_h))
+
+    if method == 'pil':
+        image = image.convert('1')
+        if p['mirror_x']:
+            image = image.transpose(Image.FLIP_LEFT_RIGHT)
+        if p['mirror_y']:
+            image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        dots = image_dots(image)
+    else:
+        if method == 'levels':
+            notes.append('(%u power levels, gamma %0.2f)' % ((1<<p['bits_per_dot'])-1, p['gamma']))
+            dots = raster_dither.quantize(numpy.asarray(image), p['bits_per_dot'], p['gamma'])
+        else:
+            notes.append('(dither %s, threshold %u, gamma %0.2f)' % (method, p['dither_threshold'], p['gamma']))
+            dots, carry = raster_dither.dither(numpy.asarray(image), method, p['dither_threshold'], p['gamma'])
+        if p['mirror_x']:
+            dots = dots[:,::-1]
+        if p['mirror_y']:
+            dots = dots[::-1]
+        image = dots_image(dots, p['bits_per_dot'])
+
+    if p['mirror_x']:
+        notes.append('(flip image left to right)')
+    if p['mirror_y']:
+        notes.append('(flip image top to bottom)')
+
+    if p['actual_image']:
+        image.save(p['actual_image'])
+
+    return dots, notes
+
+def prepare_strips(image, layout, p):
+    """Scale, dither and mirror an image strip_rows rows at a time
+
+    The source is decoded straight to 8 bit gray, at a reduced scale when
+    the format supports it (JPEG draft mode), and each strip of raster
+    rows is resampled from it on its own.  Memory for the raster sized
+    image then scales with strip_rows rather than the area of the raster.
+    Returns a list of gcode comments and a generator of (y0, dots) strips.
+    """
+    pix_w = layout['pix_w']
+    pix_h = layout['pix_h']
+    strip_rows = p['strip_rows']
+    bits_per_dot = p['bits_per_dot']
+    method = p['dither']
+    notes = []
+
+    if image.size != (pix_w, pix_h):
+        notes.append('(rescaling image to %u,%u pixels)' % (pix_w, pix_h))
+    else:
+        notes.append('(keeping image size %u,%u pixels)' % (pix_w, pix_h))
+    if bits_per_dot > 1:
+        notes.append('(%u power levels, gamma %0.2f)' % ((1<<bits_per_dot)-1, p['gamma']))
+    else:
+        if method == 'pil':
+            # PIL can't carry its dither error from one strip to the next
+            method = 'floyd-steinberg'
+        notes.append('(dither %s, threshold %u, gamma %0.2f)' % (method, p['dither_threshold'], p['gamma']))
+    notes.append('(scaling in strips of %u rows)' % strip_rows)
+    if p['mirror_x']:
+        notes.append('(flip image left to right)')
+    if p['mirror_y']:
+        notes.append('(flip image top to bottom)')
+
+    # a no-op unless the decoder can scale or convert as it decodes
+    image.draft('L', (pix_w, pix_h))
+    gray = image.convert('L')
+    (src_w, src_h) = gray.size
+    scale_y = float(src_h) / pix_h
+
+    def strips():
+        actual = None
+        if p['actual_image']:
+            actual = StripPngWriter(p['actual_image'], pix_w, pix_h, bits_per_dot)
+        carry = None
+        for y0 in xrange(0, pix_h, strip_rows):
+            y1 = min(pix_h, y0 + strip_rows)
+            # mirroring in y works up the source from the bottom, so the
+            # dither runs down the raster rather than down the image
+            (src_y0, src_y1) = (pix_h - y1, pix_h - y0) if p['mirror_y'] else (y0, y1)
+            if (src_w, src_h) == (pix_w, pix_h):
+                strip = gray.crop((0, src_y0, pix_w, src_y1))
+            else:
+                strip = gray.resize((pix_w, y1 - y0), Image.BICUBIC,
+                                    box=(0, src_y0*scale_y, src_w, src_y1*scale_y))
+            strip = numpy.asarray(strip)
+            if p['mirror_y']:
+                strip = strip[::-1]
+
+            if bits_per_dot > 1:
+                dots = raster_dither.quantize(strip, bits_per_dot, p['gamma'])
+            else:
+                dots, carry = raster_dither.dither(strip, method, p['dither_threshold'],
+                                                   p['gamma'], carry, y0)
+            if p['mirror_x']:
+                dots = dots[:,::-1]
+
+            if actual:
+                actual.write_rows(dots)
+            yield y0, dots
+        if actual:
+            actual.close()
+
+    return notes, strips()
+
+def preview_dither(image_name, methods, p):
+    """Save the image dithered at the raster resolution with each method
+
+    Writes actual_<method>.png next to actual_image and returns a list of
+    (method, seconds) so the methods can be compared quickly.
+    """
+    import time
+    image = Image.open(image_name)
+    layout = raster_layout(image.size[0], image.size[1], p)
+    gray = image.convert('L').resize((layout['pix_w'], layout['pix_h']), Image.BICUBIC)
+    gray = numpy.asarray(gray)
+    (base, ext) = os.path.splitext(p['actual_image'] or 'actual.png')
+    timings = []
+    for method in methods:
+        start = time.time()
+        dots, carry = raster_dither.dither(gray, method, p['dither_threshold'], p['gamma'])
+        timings.append((method, time.time() - start))
+        dots_image(dots).save('%s_%s%s' % (base, method, ext))
+    return timings
+
+def row_segments(row, min_gap):
+    """Return the (first,last) index of each stretch of dots in a row
+
+    Stretches are split wherever there are min_gap or more dots from one
+    burnt dot to the next, a min_gap of 0 never splits.
+    """
+    first_non_zero, last_non_zero = row_extent(row)
 
     # debug raster
     #first_non_zero, last_non_zero = (0,len(row)-1)
 
-    # some data to output
-    if (first_non_zero >= 0):
-        print('(raster line %d)' % y)
+    if first_non_zero < 0:
+        return []
+    if min_gap <= 0:
+        return [(first_non_zero, last_non_zero)]
 
-        if distribute_bits_in_floats:
-            # figure out how many max bpf floats to hold the data and
-            # then evenly distribute the bits
-            total_bits = last_non_zero - first_non_zero + 1;
-            BPF = ceil(total_bits / (ceil(float(total_bits) / MAX_BPF)))
-        else:
-	    # just pack the floats at max
-            BPF = MAX_BPF
-
-        bits = []
-        i=0
-        bitval=0
-        for v in row[first_non_zero:last_non_zero+1]:
-            if (v <= 127):
-                bitval += (1<<i)
-            i += 1
-            if (i >= BPF):
-                bits.append(bitval);
-                bitval = 0
-                i = 0
-        if (i > 0):
-            bits.append(bitval);
-
-        # forward offsets are:
-        #   X where we start
-        #     + half a dpi to center the dots
-        #     + offset to first bit to not waste time scanning air
-        #     - lead in to make sure we are at full speed before output
-	if forward:
-            offset_start = X + (1/float(XDPI)/2 + float(first_non_zero)/XDPI - leadIn)
-            offset_end = X + (1/float(XDPI)/2 + float(last_non_zero)/XDPI + leadIn)
+    index = numpy.flatnonzero(row)
+    breaks = numpy.flatnonzero(numpy.diff(index) >= min_gap)
+    firsts = [first_non_zero] + index[breaks+1].tolist()
+    lasts = index[breaks].tolist() + [last_non_zero]
+    return zip(firsts, lasts)
+
+def segment_copies(row, first_non_zero, last_non_zero, pitches):
+    """Find evenly spaced copies of a stretch's first copy along it
+
+    pitches are the dot spacings to try.  Returns the last dot of the
+    first copy and the (pitch, count) of the copies, or last_non_zero and
+    None if the stretch is not whole copies of its first pitch dots.
+    """
+    dots = row[first_non_zero:last_non_zero+1]
+    length = len(dots)
+    for pitch in pitches:
+        if pitch >= length:
+            break
+        if not numpy.array_equal(dots[pitch:], dots[:-pitch]):
+            continue
+        count = (length - 1) // pitch + 1
+        last = length - 1 - (count - 1) * pitch
+        # the last copy has to be as long as the first
+        if not dots[last+1:pitch].any():
+            return first_non_zero + last, (pitch, count)
+    return last_non_zero, None
+
+def encode_segment(row, first_non_zero, last_non_zero, p):
+    """Pack one stretch of a row, already reversed to the sweep direction
+
+    Returns (first_non_zero, last_non_zero, BPF, words).
+    """
+    bits_per_dot = p['bits_per_dot']
+    max_dots = p['MAX_BPF'] // bits_per_dot
+    if p['distribute_bits_in_floats']:
+        # figure out how many max bpf floats to hold the data and
+        # then evenly distribute the bits
+        total_bits = last_non_zero - first_non_zero + 1;
+        BPF = ceil(total_bits / (ceil(float(total_bits) / max_dots)))
+    else:
+        # just pack the floats at max
+        BPF = max_dots
+
+    words = pack_bits(row[first_non_zero:last_non_zero+1], int(BPF), bits_per_dot)
+    return (first_non_zero, last_non_zero, BPF * bits_per_dot, words)
+
+def encode_runs(row, first_non_zero, last_non_zero):
+    """Pack the runs of equal dots in one stretch of a row
+
+    Each run of burnt dots is a word of start << 28 | level << 24 | length
+    with start counted from first_non_zero, blank runs are left out.
+    """
+    dots = row[first_non_zero:last_non_zero+1].astype(numpy.uint64)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(dots)) + 1))
+    lengths = numpy.diff(numpy.concatenate((starts, [len(dots)])))
+    levels = dots[starts]
+    burnt = levels != 0
+    return ((starts[burnt].astype(numpy.uint64) << numpy.uint64(28)) |
+            (levels[burnt] << numpy.uint64(24)) | lengths[burnt].astype(numpy.uint64))
+
+def word_groups(words, data_pins=1):
+    """Split packed words into the groups loaded per data index
+
+    Returns the groups and the indexes of the groups that have to be sent.
+    """
+    # pad out the last group, zero words never fire
+    groups = numpy.zeros(-(-len(words) // data_pins) * data_pins, dtype=words.dtype)
+    groups[:len(words)] = words
+    groups = groups.reshape(-1, data_pins)
+    # we can skip zeros unless it is the last group
+    send = numpy.flatnonzero(groups[:-1].any(axis=1)).tolist() + [len(groups)-1]
+    return groups, send
+
+def data_calls(words, data_pins=1):
+    """Return the arguments of the o-word calls that load packed words
+
+    Each call is '[index] [word]...' with data_pins words, consecutive
+    words of the row going out together on one index.
+    """
+    groups, send = word_groups(words, data_pins)
+    return ['[%u] %s' % (index+1, ' '.join(['[%u]' % w for w in group]))
+            for index, group in izip(send, groups[send].tolist())]
+
+def call_gcode(calls, data_pins=1):
+    """Return the gcode to load a list of call arguments immediately
+
+    One word a call goes through o100, several through o101.
+    """
+    sub = 'o100' if data_pins == 1 else 'o101'
+    return ''.join(['%s call %s\n' % (sub, call) for call in calls])
+
+# .lrb sidecar files: magic, job, words per index, lines and where the line
+# table is, then the (index, words) entries of every line one after the
+# other, then the table of the first entry of each line and the end
+SIDECAR_MAGIC = 'LRB1'
+SIDECAR_HEADER = '<4sIIIQ'
+
+def sidecar_dtype(words_per_index):
+    """Return the numpy dtype of a sidecar entry"""
+    return numpy.dtype([('index', '<u4'), ('words', '<u8', (words_per_index,))])
+
+class SidecarWriter(object):
+    """Write the data words of raster lines to a .lrb file for rasterload.py
+
+    Each file gets a random job number the gcode passes with every M150,
+    so a line is never loaded from the sidecar of some other job.
+    """
+    def __init__(self, name, words_per_index=1):
+        self.out = open(name, 'wb')
+        self.job = struct.unpack('<I', os.urandom(4))[0] & 0xffffff
+        self.words_per_index = words_per_index
+        self.dtype = sidecar_dtype(words_per_index)
+        self.starts = [0]
+        self.write_header()
+
+    def write_header(self, table=0):
+        self.out.write(struct.pack(SIDECAR_HEADER, SIDECAR_MAGIC, self.job,
+                                   self.words_per_index, len(self.starts) - 1, table))
+
+    def write_line(self, words):
+        """Add the packed words of a raster line, returns its line number"""
+        groups, send = word_groups(words, self.words_per_index)
+        entries = numpy.zeros(len(send), dtype=self.dtype)
+        entries['index'] = numpy.array(send) + 1
+        entries['words'] = groups[send]
+        self.out.write(entries.tobytes())
+        self.starts.append(self.starts[-1] + len(entries))
+        return len(self.starts) - 2
+
+    def close(self):
+        table = self.out.tell()
+        self.out.write(numpy.array(self.starts, dtype='<u8').tobytes())
+        self.out.seek(0)
+        self.write_header(table)
+        self.out.close()
+
+def read_sidecar(name):
+    """Return (job, words_per_index, line starts, entries) of a .lrb file
+
+    The entries of line n are entries[starts[n]:starts[n+1]], they are
+    mapped rather than read.
+    """
+    size = struct.calcsize(SIDECAR_HEADER)
+    with open(name, 'rb') as f:
+        header = f.read(size)
+    if len(header) < size or header[:4] != SIDECAR_MAGIC:
+        raise ValueError('%s is not a raster sidecar file' % name)
+    magic, job, words_per_index, lines, table = struct.unpack(SIDECAR_HEADER, header)
+    data = numpy.memmap(name, mode='r')
+    entries = data[size:table].view(sidecar_dtype(words_per_index))
+    starts = data[table:table + 8*(lines+1)].view('<u8')
+    return job, words_per_index, starts, entries
+
+# the streamer is loaded with cfg=sffff, an index and four words a sample
+STREAM_WORDS = 4
+
+class StreamWriter(object):
+    """Write the data words of raster lines to a halstreamer file
+
+    Each line is its (index, words) entries, and before each line is a
+    marker sample with index -(n+1) for line n and the job number, which
+    laserraster uses to pass over samples left in the fifo from some other
+    job.  A sample is taken when the index changes, the markers keep them
+    all different.
+    """
+    def __init__(self, name, words_per_index=1):
+        self.out = open(name, 'w')
+        self.job = struct.unpack('<I', os.urandom(4))[0] & 0xffffff
+        self.words_per_index = words_per_index
+        self.lines = 0
+        self.write_marker()
+
+    def write_marker(self):
+        self.out.write('%d %u%s\n' % (-(self.lines + 1), self.job, ' 0' * (STREAM_WORDS - 1)))
+
+    def write_line(self, words):
+        """Add the packed words of a raster line, returns its line number"""
+        groups, send = word_groups(words, self.words_per_index)
+        samples = numpy.zeros((len(send), STREAM_WORDS + 1), dtype=numpy.int64)
+        samples[:, 0] = numpy.array(send) + 1
+        samples[:, 1:self.words_per_index+1] = groups[send]
+        # words are under 2**53, so halstreamer reads them exactly
+        numpy.savetxt(self.out, samples, fmt='%d')
+        self.lines += 1
+        # the marker after a line lets laserraster stop the streamer
+        self.write_marker()
+        return self.lines - 1
+
+    def close(self):
+        self.out.close()
+
+def segment_calls(words, p):
+    """Return the data_calls() that load a segment's words"""
+    # sidecar and stream lines are not loaded by calls
+    if p['sidecar'] or p['stream']:
+        return None
+    if p['estimate_only']:
+        return [''] * len(word_groups(words, p['data_pins'])[1])
+    return data_calls(words, p['data_pins'])
+
+def encode_band(band):
+    """Encode a band of rows, this is the unit of work for worker processes
+
+    band is (y0, rows, forwards, p).  Returns a list of
+    (y, forward, segments) for the rows that have dots.  Each segment is
+    (first_non_zero, last_non_zero, BPF, words, calls, runs, copies) where
+    calls are the data_calls() that load it, runs is set when words are
+    runs of dots and copies is the (pitch, count) of step and repeat
+    copies it burns from words of the first one, None for one.  Stretches
+    that are the same are encoded once and share their words.
+    """
+    y0, rows, forwards, p = band
+    min_gap = air_gap_dots(p, rows.shape[1])
+    pitches = p.get('copy_pitches')
+    shared = {} if repeats(p) else None
+    encoded_rows = []
+    for i, row in enumerate(rows):
+        forward = forwards[i]
+        if not forward:
+            row = row[::-1]
+        segments = []
+        for first_non_zero, last_non_zero in row_segments(row, min_gap):
+            if shared is not None:
+                dots = row[first_non_zero:last_non_zero+1].tostring()
+                if dots in shared:
+                    segments.append((first_non_zero, last_non_zero) + shared[dots])
+                    continue
+            (last_loaded, copies) = (last_non_zero, None)
+            if pitches:
+                last_loaded, copies = segment_copies(row, first_non_zero, last_non_zero, pitches)
+            encoded = encode_segment(row, first_non_zero, last_loaded, p)
+            runs = False
+            # run lengths have 24 bits
+            if p['rle'] and last_loaded - first_non_zero < (1<<24):
+                run_words = encode_runs(row, first_non_zero, last_loaded)
+                if (len(word_groups(run_words, p['data_pins'])[1]) <
+                    len(word_groups(encoded[3], p['data_pins'])[1])):
+                    encoded = encoded[:3] + (run_words,)
+                    runs = True
+            # the line runs over all the copies
+            segments.append((first_non_zero, last_non_zero) + encoded[2:] +
+                            (segment_calls(encoded[3], p), runs, copies))
+            if shared is not None:
+                shared[dots] = segments[-1][2:]
+        if segments:
+            encoded_rows.append((y0+i, forward, segments))
+    return encoded_rows
+
+def row_directions(pix_h, p):
+    """Return the sweep direction of every row, True is forward"""
+    if p['bidirectional_raster']:
+        # every other line is reverse direction, blank or not
+        return [y % 2 == 0 for y in xrange(pix_h)]
+    return [True] * pix_h
+
+def row_end_points(first_non_zero, last_non_zero, layout, p):
+    """Return the x where a row's raster starts and ends sweeping forward
+
+    Reversed the row starts at the forward end and ends at the start.
+    """
+    XDPI = p['XDPI']
+    leadIn = lead_in(p)
+    X = layout['X']
+    return (X + (0.5 + first_non_zero)/XDPI - leadIn,
+            X + (0.5 + last_non_zero)/XDPI + leadIn)
+
+def rapid_time(start, end, p):
+    """Seconds for a G0 between two (x,y) points"""
+    (rapid, rapid_accel) = rapid_speed(p)
+    return move_time(sqrt((end[0]-start[0])**2 + (end[1]-start[1])**2), rapid, rapid_accel)
+
+def travel_time(forwards, ys, starts, ends, pos, layout, p):
+    """Seconds of G0 to visit the given rows starting at pos
+
+    Returns the time and where the head ends up.
+    """
+    YDPI = float(p['YDPI'])
+    total = 0.0
+    for forward, y, start, end in izip(forwards, ys, starts, ends):
+        if not forward:
+            (start, end) = (end, start)
+        offset_y = layout['Y'] - 0.5/YDPI - y/YDPI
+        total += rapid_time(pos, (start, offset_y), p)
+        pos = (end, offset_y)
+    return total, pos
+
+def plan_directions(firsts, lasts, y0, pos, layout, p):
+    """Choose the sweep direction of each row to minimise G0 travel
+
+    firsts and lasts are the extents of rows y0 on and pos is where the
+    head starts.  Every row is a choice of forward or reverse, the
+    cheapest sequence is found by dynamic programming over the rows that
+    have dots, with the rapid from the end of one row to the start of the
+    next costed as a trapezoid move.  Lead in and raster sweep time do not
+    depend on the direction so they drop out.  Returns the directions of
+    the rows, the estimated G0 seconds and where the head ends up.
+    """
+    YDPI = float(p['YDPI'])
+    ys = numpy.flatnonzero(firsts >= 0)
+    starts, ends = row_end_points(firsts[ys], lasts[ys], layout, p)
+
+    # cost and end of the path ending each row forward (0) or reversed (1)
+    costs = [0.0, 0.0]
+    ends_at = [pos, pos]
+    choices = []
+    for y, start, end in izip(ys, starts, ends):
+        offset_y = layout['Y'] - 0.5/YDPI - (y0+y)/YDPI
+        new_costs = []
+        choice = []
+        for begin in (start, end):
+            options = [costs[d] + rapid_time(ends_at[d], (begin, offset_y), p) for d in (0, 1)]
+            best = 0 if options[0] <= options[1] else 1
+            new_costs.append(options[best])
+            choice.append(best)
+        costs = new_costs
+        ends_at = [(end, offset_y), (start, offset_y)]
+        choices.append(choice)
+
+    state = 0 if costs[0] <= costs[1] else 1
+    planned = costs[state]
+    pos = ends_at[state]
+
+    forwards = [True] * len(firsts)
+    for i in xrange(len(ys)-1, -1, -1):
+        forwards[ys[i]] = (state == 0)
+        state = choices[i][state]
+
+    return forwards, planned, pos
+
+def raster_bands(strips, layout, p, stats):
+    """Split strips of dots into bands of rows with their sweep directions
+
+    Yields the (y0, rows, forwards, p) bands encode_band() works on.  When
+    planning directions each strip is planned as it arrives, carrying on
+    from where the previous strip left the head, and the rapid time of
+    the plan and of plain alternation are totalled in stats.
+    """
+    band_rows = max(1, p['band_rows'])
+    home = (layout['X'], layout['Y'])
+    plan_pos = alternate_pos = home
+    stats['planned'] = stats['alternating'] = 0.0
+
+    for y0, dots in strips:
+        if p['plan_directions']:
+            firsts, lasts = row_extents(dots)
+            forwards, planned, plan_pos = plan_directions(firsts, lasts, y0, plan_pos, layout, p)
+            stats['planned'] += planned
+
+            ys = numpy.flatnonzero(firsts >= 0)
+            starts, ends = row_end_points(firsts[ys], lasts[ys], layout, p)
+            alternating, alternate_pos = travel_time([(y0+y) % 2 == 0 for y in ys], y0+ys,
+                                                     starts, ends, alternate_pos, layout, p)
+            stats['alternating'] += alternating
         else:
-            offset_start = X + (W - 1/float(XDPI)/2 - float(first_non_zero)/XDPI + leadIn)
-            offset_end = X + (W - 1/float(XDPI)/2 - float(last_non_zero)/XDPI - leadIn)
+            forwards = row_directions(y0 + len(dots), p)[y0:]
 
-        print('G0 X%0.4f Y%0.4f' % (offset_start,offset_y))
-        print('M68 E1 Q-1 (start new line)')
-        if first_output:
-            # only have to send this on the first line output
-            print('o100 call [-2] [%d] (gcode is metric 0=no,1=yes)' % (1 if is_metric else 0))
-            print('o100 call [-3] [#<raster_speed>] (speed, in/min or mm/min)')
-        print('o100 call [-4] [%d] (direction)' % (1 if forward else -1))
+        for b in xrange(0, len(dots), band_rows):
+            yield (y0+b, dots[b:b+band_rows], forwards[b:b+band_rows], p)
+
+    # back to the start at the end of the job
+    stats['planned'] += rapid_time(plan_pos, home, p)
+    stats['alternating'] += rapid_time(alternate_pos, home, p)
+
+def encoded_bands(bands, p):
+    """Yield the encoded rows of each band, in order
+
+    The bands are spread over a pool of worker processes when
+    p['processes'] is not 1, the results still come back in row order.
+    Only a couple of bands per worker are handed out ahead of the one
+    being yielded so the bands can be produced lazily.
+    """
+    if p['processes'] == 1:
+        for encoded_rows in imap(encode_band, bands):
+            yield encoded_rows
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(p['processes'] or None)
+    ahead = 2 * (p['processes'] or multiprocessing.cpu_count())
+    try:
+        pending = deque()
+        for band in bands:
+            pending.append(pool.apply_async(encode_band, (band,)))
+            if len(pending) > ahead:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def sweep_ends(first_non_zero, last_non_zero, forward, layout, p):
+    """Return the X the G1 of a stretch of a row starts and ends at"""
+    XDPI = p['XDPI']
+    W = layout['W']
+    X = layout['X']
+    leadIn = lead_in(p)
+
+    # forward offsets are:
+    #   X where we start
+    #     + half a dpi to center the dots
+    #     + offset to first bit to not waste time scanning air
+    #     - lead in to make sure we are at full speed before output
+    if forward:
+        offset_start = X + (1/float(XDPI)/2 + float(first_non_zero)/XDPI - leadIn)
+        offset_end = X + (1/float(XDPI)/2 + float(last_non_zero)/XDPI + leadIn)
+    else:
+        offset_start = X + (W - 1/float(XDPI)/2 - float(first_non_zero)/XDPI + leadIn)
+        offset_end = X + (W - 1/float(XDPI)/2 - float(last_non_zero)/XDPI - leadIn)
+    return offset_start, offset_end
+
+def line_headers(BPF, forward, runs, first_output, p, copies=None):
+    """Return the o100 calls of the headers that set up a raster line"""
+    lines = []
+    if first_output:
+        # only have to send this on the first line output
+        lines.append('o100 call [-2] [%d] (gcode is metric 0=no,1=yes)\n' % (1 if p['is_metric'] else 0))
+        if p['raster_axis'] == 'y':
+            lines.append('o100 call [-17] [1] (raster axis 0=X,1=Y)\n')
+        lines.append('o100 call [-3] [#<raster_speed>] (speed, in/min or mm/min)\n')
+    lines.append('o100 call [-4] [%d] (direction)\n' % (1 if forward else -1))
+    if first_output:
+        lines.append('o100 call [-5] [%0.3f] (dpi)\n' % p['XDPI'])
+    if p['distribute_bits_in_floats'] or first_output:
+        lines.append('o100 call [-6] [%u] (bits per float)\n' % BPF)
+    if first_output:
+        lines.append('o100 call [-7] [%d] (laser on time, ns)\n' % (p['laser_on_time']*1000000))
+        if p['bits_per_dot'] != 1:
+            lines.append('o100 call [-9] [%u] (bits per dot)\n' % p['bits_per_dot'])
+        if p['data_pins'] != 1:
+            lines.append('o100 call [-10] [%u] (words per index)\n' % p['data_pins'])
+        if p['lead_in_mode'] == 'compensated':
+            lines.append('o100 call [-14] [1] (speed compensation)\n')
+        if p['cw_mode']:
+            lines.append('o100 call [-15] [1] (cw mode)\n')
+            if p['min_off_gap'] > 0:
+                lines.append('o100 call [-16] [%0.4f] (min off gap)\n' % p['min_off_gap'])
+        if p['forward_offset'] or p['reverse_offset']:
+            lines.append('o100 call [-18] [%0.5f] (forward offset)\n' % p['forward_offset'])
+            lines.append('o100 call [-19] [%0.5f] (reverse offset)\n' % p['reverse_offset'])
+    if p['rle']:
+        lines.append('o100 call [-11] [%u] (encoding 0=bitmap,1=runs)\n' % (1 if runs else 0))
+    if copies:
+        # the start of a line takes laserraster back to one copy
+        lines.append('o100 call [-23] [%u] (copy pitch, dots)\n' % copies[0])
+        lines.append('o100 call [-24] [%u] (copies)\n' % copies[1])
+    # have to send last parameters as this triggers the line init
+    lines.append('o100 call [-8] [%0.4f] (lead in)\n' % lead_in(p))
+    return lines
+
+def segment_gcode(segment, forward, offset_y, first_output, layout, p, sidecar=None, stream=None,
+                  repeat=False):
+    """Return the gcode to burn one encoded stretch of a row
+
+    The data goes in the gcode, to sidecar if it is a SidecarWriter or to
+    stream if it is a StreamWriter.  A repeat burns the data of the line
+    before again, which has to be the same.
+    """
+    first_non_zero, last_non_zero, BPF, words, calls, runs, copies = segment
+    offset_start, offset_end = sweep_ends(first_non_zero, last_non_zero, forward, layout, p)
+    lines = []
+
+    lines.append('G0 %s%0.4f %s%0.4f\n' % (layout['axes'][0], offset_start, layout['axes'][1], offset_y))
+    if not repeat:
+        lines.append('M68 E1 Q-1 (start new line)\n')
+    lines.extend(line_headers(BPF, forward, runs, first_output, p, copies))
+    lines.append('(raster data start)\n')
+
+    if repeat:
+        # the step mask still holds it, the headers above changed the index
+        lines.append('o100 call [-22] [0] (repeat line)\n')
+    elif sidecar:
+        lines.append('M150 P%u Q%u (load line)\n' % (sidecar.write_line(words), sidecar.job))
+    elif stream:
+        # the line starts here and loads from the streamer as it burns
         if first_output:
-            print('o100 call [-5] [%0.3f] (dpi)' % XDPI)
-        if distribute_bits_in_floats or first_output:
-            print('o100 call [-6] [%u] (bits per float)' % BPF)
+            lines.append('o100 call [-21] [%u] (stream job)\n' % stream.job)
+        lines.append('o100 call [-20] [%u] (stream line)\n' % stream.write_line(words))
+    else:
+        lines.append(call_gcode(calls, p['data_pins']))
+
+    lines.append('G1 %s%0.4f\n' % (layout['axes'][0], offset_end))
+    lines.append('M1\n')
+    return ''.join(lines)
+
+
+def buffered_calls(segment, forward, p):
+    """Return the call arguments that load a line into the back buffer"""
+    first_non_zero, last_non_zero, BPF, words, calls, runs, copies = segment
+    pad = ' [0]' * (p['data_pins'] - 1)
+    headers = ['[-1] [%d]%s' % (1 if forward else -1, pad)]
+    if copies:
+        headers.append('[-23] [%u]%s' % (copies[0], pad))
+        headers.append('[-24] [%u]%s' % (copies[1], pad))
+    if p['rle']:
+        headers.append('[-11] [%u]%s' % (1 if runs else 0, pad))
+    if p['distribute_bits_in_floats']:
+        headers.append('[-6] [%u]%s' % (BPF, pad))
+    return headers + calls
+
+def buffered_gcode(lines, layout, p):
+    """Yield the gcode of double buffered raster lines
+
+    lines are (y, forward, segment).  laserraster loads each line into a
+    second step mask while the line before it burns.  The G1 of a line is
+    cut into pieces and the calls that load the next line go out on M67,
+    which motion sets as each piece starts.  Whatever doesn't fit is
+    loaded with M68 once the line is done, and M67 E1 Q-13 swaps the masks
+    as the next G1 starts.
+    """
+    YDPI = float(p['YDPI'])
+    min_move = p['preload_min_move']
+    if min_move < 0:
+        min_move = lead_in(p)
+
+    lines = iter(lines)
+    current = next(lines, None)
+    loaded = 0
+    last_y = None
+    first_output = True
+    while current is not None:
+        following = next(lines, None)
+        y, forward, segment = current
+        offset_start, offset_end = sweep_ends(segment[0], segment[1], forward, layout, p)
+        offset_y = layout['Y'] - 1/YDPI/2 - float(y)/YDPI
+
+        out = []
+        if y != last_y:
+            out.append('(raster line %d)\n' % y)
+            last_y = y
+        out.append('G0 %s%0.4f %s%0.4f\n' % (layout['axes'][0], offset_start, layout['axes'][1], offset_y))
         if first_output:
-            print('o100 call [-7] [%d] (laser on time, ns)' % (laser_on_time*1000000))
-        # have to send last parameters as this triggers the line init
-        print('o100 call [-8] [%0.4f] (lead in)' % leadIn)
-        print('(raster data start)')
+            out.append('M68 E1 Q-1 (start new line)\n')
+            out.extend(line_headers(segment[2], forward, segment[5], True, p))
+            out.append('o100 call [-12] [1] (double buffer)\n')
+        calls = buffered_calls(segment, forward, p)
+        if loaded < len(calls):
+            out.append('(raster data start)\n')
+            out.append(call_gcode(calls[loaded:], p['data_pins']))
+        out.append('M67 E1 Q-13 (start line with the G1)\n')
+
+        # load as much of the next line as there are long enough pieces
+        next_calls = buffered_calls(following[2], following[1], p) if following else []
+        pieces = int(abs(offset_end - offset_start) / min_move) if min_move > 0 else 1
+        loaded = max(0, min(len(next_calls), pieces - 1))
+        for k in xrange(1, loaded + 2):
+            if k > 1:
+                out.append('o102 call %s\n' % next_calls[k-2])
+            out.append('G1 %s%0.4f\n' % (layout['axes'][0],
+                                          offset_start + (offset_end - offset_start) * k / (loaded + 1)))
+        yield ''.join(out)
 
+        current = following
         first_output = False
 
-        bits_length = len(bits)
-        for index, bitval in enumerate(bits):
-            if bitval != 0 or index == bits_length-1:
-                # we can skip zeros unless it is the last float
-                print('o100 call [%u] [%u]' % (index+1, bitval))
+def generate_raster(image, params=None):
+    """Generate the gcode to raster engrave an image
+
+    image is a file name or a PIL image, params is a dict overriding
+    default_params.  This is a generator yielding chunks of one or more
+    complete gcode lines as they are produced, so the first lines are
+    available before the image has been encoded.
+    """
+    p = dict(default_params)
+    if params:
+        unknown = set(params) - set(p)
+        if unknown:
+            raise ValueError('unknown raster parameters: %s' % ', '.join(sorted(unknown)))
+        p.update(params)
+    if p['data_pins'] not in (1, 2, 3, 4):
+        raise ValueError('data_pins=%s, use 1 to 4' % p['data_pins'])
+    if p['lead_in_mode'] not in ('full', 'compensated'):
+        raise ValueError('lead_in_mode=%s, use full or compensated' % p['lead_in_mode'])
+    if not 0 < p['compensated_speed'] <= 1:
+        raise ValueError('compensated_speed=%s, use more than 0 up to 1' % p['compensated_speed'])
+    if p['raster_axis'] not in ('x', 'y', 'auto'):
+        raise ValueError('raster_axis=%s, use x, y or auto' % p['raster_axis'])
+    if p['sidecar'] is True:
+        raise ValueError('sidecar=True needs a file name, the command line takes it from -o')
+    if p['sidecar'] and p['double_buffer']:
+        raise ValueError('sidecar can not double_buffer, M150 waits for motion to stop')
+    if p['stream'] is True:
+        raise ValueError('stream=True needs a file name, the command line takes it from -o')
+    if p['stream'] and (p['double_buffer'] or p['sidecar']):
+        raise ValueError('stream can not double_buffer or go with sidecar, lines load as they burn')
+    if len(p['repeat_grid']) != 2 or min(p['repeat_grid']) < 1:
+        raise ValueError('repeat_grid=%s, use (columns, rows)' % (p['repeat_grid'],))
+    if len(p['repeat_pitch']) != 2:
+        raise ValueError('repeat_pitch=%s, use (x, y)' % (p['repeat_pitch'],))
+    if p['repeat_at'] and tuple(p['repeat_grid']) != (1, 1):
+        raise ValueError('repeat_at and repeat_grid both place copies, use one')
+
+    if isinstance(image, basestring):
+        image_name = image
+        image = Image.open(image_name)
+    else:
+        image_name = getattr(image, 'filename', '')
+    layout = raster_layout(image.size[0], image.size[1], p)
+    batch = repeat_layout(layout, p)
+
+    cache = keys = None
+    if p['cache_dir']:
+        cache = raster_cache.RasterCache(p['cache_dir'], p['cache_size'] * 1000000)
+        keys = cache_keys(image_name if os.path.isfile(image_name) else image, image_name,
+                          layout, batch, p)
+        if keys['gcode']:
+            chunks = cache.read_gcode(keys['gcode'])
+            # the actual image comes from the cached dots
+            if chunks is not None and (not p['actual_image'] or cached_actual_image(cache, keys, batch, p)):
+                for chunk in chunks:
+                    yield chunk
+                return
 
-        print('G1 X%0.4f' % offset_end)
-        print('M1')
+    chunks = raster_gcode(image, image_name, layout, batch, p, cache, keys)
+    del image
+    if keys and keys['gcode']:
+        chunks = cache.write_gcode(keys['gcode'], chunks)
+    for chunk in chunks:
+        yield chunk
 
-    if bidirectional_raster:
-        # next line is reverse direction
-        forward = not forward
+def cache_keys(image, image_name, layout, batch, p):
+    """Return the raster_cache entries of a job's dots, rows and gcode
+
+    Each is keyed by only what goes into it, so the dots and rows of an
+    image are found again after a change to the power, speed or origin.
+    The dots are of one copy, the rows and the actual image of the whole
+    batch.  The gcode entry is None for gcode that goes with a data file.
+    """
+    image_key = raster_cache.image_hash(image)
+    dots = raster_cache.key('dots', image_key, layout['pix_w'], layout['pix_h'], p['dither'],
+                            p['dither_threshold'], p['gamma'], p['bits_per_dot'],
+                            p['mirror_x'], p['mirror_y'], p['strip_rows'])
+
+    axis = p['raster_axis']
+    if axis == 'auto':
+        axis = choose_raster_axis(batch, p)[0]
+    (raster, raster_p) = (batch, p)
+    if axis == 'y':
+        (raster, raster_p) = sweep_frame(batch, p)
+    rows = [dots, axis, p['MAX_BPF'], p['distribute_bits_in_floats'], p['rle'], p['data_pins'],
+            air_gap_dots(raster_p, raster['pix_w']), p['bidirectional_raster'], p['plan_directions'],
+            batch.get('copies')]
+    if p['plan_directions']:
+        # the plan goes by where the rows are and the rapids between them
+        rows += [raster['X'], raster['Y'], raster_p['XDPI'], raster_p['YDPI'],
+                 lead_in(raster_p), rapid_speed(raster_p)]
+
+    gcode = None
+    if not (p['sidecar'] or p['stream'] or p['estimate_only']):
+        params = sorted((name, value) for name, value in p.items() if name not in UNCACHED_PARAMS)
+        gcode = raster_cache.key('gcode', image_key, image_name, axis, params)
+    image = raster_cache.key('image', dots, batch.get('copies'))
+    return dict(dots=dots, image=image, rows=raster_cache.key(*rows), gcode=gcode)
+
+def cached_actual_image(cache, keys, batch, p, dots=None):
+    """Save the actual image from the cache, False if it isn't there
+
+    A copy of the image is kept, failing that it is made again from the
+    dots of one copy, given or cached.
+    """
+    if cache.load_file(keys['image'], raster_cache.PNG, p['actual_image']):
+        return True
+    if dots is None:
+        cached = cache.load_dots(keys['dots'])
+        if cached is None:
+            return False
+        dots = cached[0]
+    if 'copies' in batch:
+        dots = repeat_dots(dots, batch)
+    dots_image(dots, p['bits_per_dot']).save(p['actual_image'])
+    cache.save_file(keys['image'], raster_cache.PNG, p['actual_image'])
+    return True
+
+def raster_gcode(image, image_name, layout, batch, p, cache=None, keys=None):
+    """Generate the gcode of generate_raster() once the layout is known
+
+    layout is of one copy of the image and batch of all of them.
+    """
+    YDPI = p['YDPI']
+    is_metric = p['is_metric']
+
+    yield '%\n'
+    yield '(image = %s)\n' % image_name
+    yield '(image size w=%u,h=%u)\n' % image.size
+
+    for note in layout['notes']:
+        yield note + '\n'
+    if batch is not layout:
+        for note in batch['notes']:
+            yield note + '\n'
+    pix_h = batch['pix_h']
+    W = batch['W']
+    H = batch['H']
+    X = batch['X']
+    Y = batch['Y']
+
+    rows = cache.read_rows(keys['rows']) if cache else None
+    strips = None
+    # a batch's actual image is saved once the copies are placed
+    save_batch = False
+    if rows is not None:
+        prepared = rows[0]
+    if rows is None or (p['actual_image'] and not cached_actual_image(cache, keys, batch, p)):
+        dots = cache.load_dots(keys['dots']) if cache else None
+        one = p
+        if batch is not layout and p['actual_image']:
+            (one, save_batch) = (dict(p, actual_image=None), True)
+        if dots is not None:
+            (dots, prepared) = dots
+            save_batch = False
+            if p['actual_image']:
+                cached_actual_image(cache, keys, batch, p, dots)
+        elif p['strip_rows'] > 0:
+            prepared, strips = prepare_strips(image, layout, one)
+        else:
+            dots, prepared = prepare_image(image, layout, one)
+            if cache:
+                cache.save_dots(keys['dots'], dots, prepared)
+        if dots is not None:
+            strips = iter([(0, dots)])
+        del dots
+    if batch is not layout and strips is not None:
+        # the rows of the copies side by side are swept together
+        dots = repeat_dots(numpy.concatenate([strip for y0, strip in strips]), batch)
+        if save_batch:
+            dots_image(dots, p['bits_per_dot']).save(p['actual_image'])
+        strips = iter([(0, dots)])
+        del dots
+    if rows is not None and strips is not None:
+        # the strips were only wanted for the actual image
+        for strip in strips:
+            pass
+        strips = None
+    del image
+    for note in prepared:
+        yield note + '\n'
+
+    layout = batch
+    if p['raster_axis'] == 'auto':
+        p['raster_axis'], notes = choose_raster_axis(layout, p)
+        for note in notes:
+            yield note + '\n'
+    if p['raster_axis'] == 'y':
+        if strips is not None:
+            # the rows are the image columns, which takes the whole image
+            dots = numpy.concatenate([strip for y0, strip in strips])
+            strips = iter([(0, frame_dots(dots))])
+            del dots
+        raster, p = sweep_frame(layout, p)
+        YDPI = p['YDPI']
+        yield '(raster along y)\n'
+    else:
+        raster = layout
+    if 'copies' in layout:
+        # copies can be burnt from one load wherever the rows sweep across
+        # them at the spacing of neighbouring copies
+        along = sorted(set(copy[1 if p['raster_axis'] == 'y' else 0] for copy in layout['copies']))
+        p = dict(p, copy_pitches=sorted(set(b - a for a, b in zip(along, along[1:]))))
+
+    # gcode header
+    if is_metric:
+        yield 'G21\n'
+    else:
+        yield 'G20\n'
+    yield 'M63 P0 (turn off laser dout)\n'
+    yield 'G0 Z0 (turn off magic z)\n'
+    yield 'G64 P0.0001 Q0.0001 (minimal path blending)\n'
+    yield 'M68 E0 Q%0.3f (set laser power level)\n' % p['laser_power']
+    yield 'M3 S1 (master laser power on)\n'
+    if p['air_assist']:
+        yield 'M7 (air assist on)\n'
+    yield '#<raster_speed> = %0.3f\n' % p['SPEED']
+    yield 'F[#<raster_speed>]\n'
+
+    # gcode skip lines that show raster image run box
+    if p['output_optional_border']:
+        yield '/ G0 X%0.4f Y%0.4f\n' % (X,Y)
+        yield '/ G1 X%0.4f Y%0.4f\n' % (X+W,Y)
+        yield '/ G1 X%0.4f Y%0.4f\n' % (X+W,Y-H)
+        yield '/ G1 X%0.4f Y%0.4f\n' % (X,Y-H)
+        yield '/ G1 X%0.4f Y%0.4f\n' % (X,Y)
+        yield '/ M2\n'
+
+    yield 'o100 sub\n'
+    yield '  M68 E2 Q[#2]\n'
+    yield '  M68 E1 Q[#1]\n'
+    yield 'o100 endsub\n'
+    if p['data_pins'] != 1:
+        # data words first, the index change makes laserraster load them
+        yield 'o101 sub\n'
+        for pin in xrange(p['data_pins']):
+            yield '  M68 E%u Q[#%u]\n' % (pin+2, pin+2)
+        yield '  M68 E1 Q[#1]\n'
+        yield 'o101 endsub\n'
+    if p['double_buffer']:
+        # loads synchronized with the start of the next motion
+        yield 'o102 sub\n'
+        for pin in xrange(p['data_pins']):
+            yield '  M67 E%u Q[#%u]\n' % (pin+2, pin+2)
+        yield '  M67 E1 Q[#1]\n'
+        yield 'o102 endsub\n'
+
+    min_gap = air_gap_dots(p, raster['pix_w'])
+    if min_gap:
+        yield '(split lines at gaps of %u dots or more)\n' % min_gap
+
+    first_output = True
+    stats = {}
+    sidecar = None
+    if p['sidecar']:
+        sidecar = SidecarWriter(p['sidecar'], p['data_pins'])
+        yield '(raster data in %s, job %u)\n' % (os.path.basename(p['sidecar']), sidecar.job)
+    stream = None
+    if p['stream']:
+        stream = StreamWriter(p['stream'], p['data_pins'])
+        yield '(raster data in %s, job %u, start halstreamer on it first)\n' % (
+            os.path.basename(p['stream']), stream.job)
+
+    if rows is not None:
+        # the calls are made again from the words, with the params of the time
+        (bands, stats) = rows[1:]
+        encoded = ([(y, forward, [segment[:4] + (segment_calls(segment[3], p),) + segment[5:]
+                                  for segment in segments])
+                    for y, forward, segments in encoded_rows]
+                   for encoded_rows in bands)
+    else:
+        encoded = encoded_bands(raster_bands(strips, raster, p, stats), p)
+        if cache:
+            encoded = cache.write_rows(keys['rows'], prepared, encoded, stats)
+    if p['double_buffer']:
+        lines = ((y, forward, segment)
+                 for encoded_rows in encoded
+                 for y, forward, segments in encoded_rows
+                 for segment in segments)
+        for chunk in buffered_gcode(lines, raster, p):
+            yield chunk
+    else:
+        (last, last_forward) = (None, None)
+        for encoded_rows in encoded:
+            for y, forward, segments in encoded_rows:
+                offset_y = raster['Y'] - 1/float(YDPI)/2 - float(y)/YDPI
+                lines = ['(raster line %d)\n' % y]
+                for segment in segments:
+                    # copies share the words of the line they repeat
+                    repeat = last is not None and segment[3] is last[3] and forward == last_forward
+                    lines.append(segment_gcode(segment, forward, offset_y, first_output, raster, p,
+                                               sidecar, stream, repeat))
+                    first_output = False
+                    (last, last_forward) = (segment, forward)
+                yield ''.join(lines)
+    if sidecar:
+        sidecar.close()
+    if stream:
+        stream.close()
+    if cache and p['actual_image'] and not cache.get(keys['image'], raster_cache.PNG):
+        cache.save_file(keys['image'], raster_cache.PNG, p['actual_image'])
+
+    if p['plan_directions']:
+        yield '(planned directions, %0.1f s of rapids, %0.1f s less than alternating)\n' % (
+            stats['planned'], stats['alternating'] - stats['planned'])
+
+    yield 'M68 E1 Q0 (end raster)\n'
+
+    yield 'G0 X%0.4f Y%0.4f (go to start)\n' % (X,Y)
+    yield 'M2\n'
+    yield '%\n'
+
+def calibration_image(bands, p, band_rows=12, gap_rows=6, width=1.0, bar_every=10):
+    """Return a PIL image of bands of thin vertical bars
+
+    Rastered in both directions a band's bars only come out straight when
+    its reverse rows line up with the forward ones.  A block left of the
+    bars marks the middle band.
+    """
+    XDPI = p['XDPI']
+    pix_w = int(width * XDPI)
+    margin = 3 * bar_every
+    rows = bands * (band_rows + gap_rows)
+    dots = numpy.zeros((rows, margin + pix_w), dtype=bool)
+    for band in xrange(bands):
+        y0 = band * (band_rows + gap_rows)
+        dots[y0:y0+band_rows, margin::bar_every] = True
+        if band == bands // 2:
+            dots[y0:y0+band_rows, :bar_every] = True
+    return Image.fromarray(numpy.where(dots, 0, 255).astype(numpy.uint8))
+
+def ini_reverse_offset(axis, p):
+    """Return the INI's RASTER_REVERSE_OFFSET and the steps per inch or mm
+    of the axis"""
+    ini, scale = read_ini(p)
+    offset = 0
+    if ini.has_option('LASER', 'RASTER_REVERSE_OFFSET'):
+        offset = int(float(ini.get('LASER', 'RASTER_REVERSE_OFFSET')))
+    steps = 0
+    section = 'AXIS_1' if axis == 'y' else 'AXIS_0'
+    if ini.has_option(section, 'SCALE'):
+        steps = abs(float(ini.get(section, 'SCALE'))) / scale
+    return offset, steps
+
+def generate_calibration(step, params=None, bands=11):
+    """Generate gcode to measure the reverse offset of a bidirectional raster
+
+    Each band of calibration_image() is burnt with the reverse offset
+    changed by step (inches or mm) from the band before, centered on the
+    INI's RASTER_REVERSE_OFFSET moved by reverse_offset.  Read the band
+    whose bars are straight, counting from the marked middle one, and set
+    RASTER_REVERSE_OFFSET to the steps noted for it.
+    """
+    p = dict(default_params)
+    if params:
+        p.update(params)
+    band_rows, gap_rows = 12, 6
+    # auto could pick either axis, the steps are only right for one
+    axis = 'y' if p['raster_axis'] == 'y' else 'x'
+    p.update(bidirectional_raster=True, plan_directions=False, double_buffer=False,
+             dither='threshold', bits_per_dot=1, raster_w=-1, raster_h=-1, YDPI=p['XDPI'],
+             raster_axis=axis)
+    image = calibration_image(bands, p, band_rows, gap_rows)
+    # the -19 of each band adds to the INI's offset
+    offsets = [p['reverse_offset'] + (band - bands//2)*step for band in xrange(bands)]
+    ini_reverse, steps = ini_reverse_offset(axis, p)
+
+    band = -1
+    for chunk in generate_raster(image, p):
+        if chunk.startswith('(raster line '):
+            y = int(chunk[len('(raster line '):chunk.index(')')])
+            if y // (band_rows + gap_rows) != band:
+                band = y // (band_rows + gap_rows)
+                # after the first line's -2 so the units are known
+                headers = ('o100 call [-18] [%0.5f] (forward offset)\n' % p['forward_offset'] +
+                           'o100 call [-19] [%0.5f] (reverse offset)\n' % offsets[band])
+                yield '(band %d, reverse offset %0.5f, RASTER_REVERSE_OFFSET = %d)\n' % (
+                    band - bands//2, offsets[band], ini_reverse + int(floor(offsets[band]*steps + 0.5)))
+                chunk = chunk.replace('(raster data start)\n', headers + '(raster data start)\n', 1)
+        yield chunk
+
+# seconds a user M-code like M150 holds the program up, roughly
+MCODE_TIME = 0.01
+
+def gcode_time(chunks, p):
+    """Estimate how long raster gcode takes to run
+
+    chunks is the gcode as generate_raster() yields it.  Moves are
+    trapezoids at the speed and acceleration the INI allows along them,
+    and G1s carrying on in the same direction with nothing that waits for
+    motion in between are one move.  Each M1 takes line_overhead, each
+    M68 a servo period and each M150 MCODE_TIME.  Returns the seconds
+    spent burning, in the lead in and out of the G1s, in G0s and paused,
+    the number of raster lines (G1 sweeps) and gcode lines and the
+    fastest a sweep ran within the limits.
+    """
+    limits = axis_limits(p)
+    ini, scale = read_ini(p)
+    traj_speed = 0
+    if ini.has_option('TRAJ', 'MAX_LINEAR_VELOCITY'):
+        traj_speed = float(ini.get('TRAJ', 'MAX_LINEAR_VELOCITY')) * scale * 60
+    servo_period = 0.001
+    if ini.has_option('EMCMOT', 'SERVO_PERIOD'):
+        servo_period = float(ini.get('EMCMOT', 'SERVO_PERIOD')) / 1e9
+    leadIn = lead_in(p)
+
+    estimate = dict(burn=0.0, lead=0.0, rapid=0.0, pause=0.0, sweeps=0, lines=0, speed=0.0)
+    words = re.compile(r'([A-Z])\s*(\[[^\]]*\]|[-+]?[\d.]+)')
+    subs = {}
+    sub = None
+    params = {}
+    pos = (0.0, 0.0)
+    feed = p['SPEED']
+    # the G1s that run together as (start, end)
+    sweep = [None]
+
+    def move(start, end, speed):
+        # the speed and acceleration along the move that keep each axis
+        # within its limits
+        length = hypot(end[0] - start[0], end[1] - start[1])
+        accel = float('inf')
+        for i, axis in enumerate('xy'):
+            part = abs(end[i] - start[i]) / length if length else 0
+            if part:
+                speed = min(speed, limits[axis][0] / part)
+                accel = min(accel, limits[axis][1] / part)
+        if traj_speed > 0:
+            speed = min(speed, traj_speed)
+        return length, speed, move_time(length, speed, accel) if length else 0.0
+
+    def stop():
+        if sweep[0] is None:
+            return
+        length, speed, seconds = move(sweep[0][0], sweep[0][1], feed)
+        # the dots are swept at full speed between the leads
+        burn = min(seconds, max(0.0, length - 2*leadIn) / (speed/60.0))
+        estimate['burn'] += burn
+        estimate['lead'] += seconds - burn
+        estimate['sweeps'] += 1
+        estimate['speed'] = max(estimate['speed'], speed)
+        sweep[0] = None
+
+    def value(text):
+        if text.startswith('['):
+            text = text[1:-1].strip()
+        if text.startswith('#<'):
+            return params[text[2:-1]]
+        return float(text)
+
+    for chunk in chunks:
+        for line in chunk.splitlines():
+            estimate['lines'] += 1
+            text = re.sub(r'\([^)]*\)', '', line).strip()
+            # the border is skipped with block delete
+            if not text or text[0] in '/%':
+                continue
+            code = text.split()
+            if sub is not None:
+                if code[:2] == [sub, 'endsub']:
+                    sub = None
+                else:
+                    subs[sub] += text.count('M68')
+                continue
+            if code[0].startswith('o') and len(code) > 1:
+                if code[1] == 'sub':
+                    sub = code[0]
+                    subs[sub] = 0
+                elif code[1] == 'call' and subs[code[0]]:
+                    stop()
+                    estimate['pause'] += subs[code[0]] * servo_period
+                continue
+            m = re.match(r'#<(\w+)>\s*=\s*([-+\d.]+)', text)
+            if m:
+                params[m.group(1)] = float(m.group(2))
+                continue
+
+            codes = dict(words.findall(text))
+            if 'F' in codes:
+                feed = value(codes['F'])
+            if codes.get('M') == '68':
+                stop()
+                estimate['pause'] += servo_period
+            elif codes.get('M') == '1':
+                stop()
+                estimate['pause'] += p['line_overhead']
+            elif codes.get('M') == '150':
+                stop()
+                estimate['pause'] += MCODE_TIME
+            elif codes.get('G') in ('0', '1'):
+                end = (value(codes['X']) if 'X' in codes else pos[0],
+                       value(codes['Y']) if 'Y' in codes else pos[1])
+                if codes['G'] == '0':
+                    stop()
+                    estimate['rapid'] += move(pos, end, float('inf'))[2]
+                elif sweep[0] is None:
+                    sweep[0] = (pos, end)
+                else:
+                    start, last = sweep[0]
+                    # carries on only if it goes the same way
+                    cross = (last[0]-start[0])*(end[1]-last[1]) - (last[1]-start[1])*(end[0]-last[0])
+                    dot = (last[0]-start[0])*(end[0]-last[0]) + (last[1]-start[1])*(end[1]-last[1])
+                    if abs(cross) < 1e-9 and dot > 0:
+                        sweep[0] = (start, end)
+                    else:
+                        stop()
+                        sweep[0] = (pos, end)
+                pos = end
+    stop()
+    return estimate
+
+def estimate_time(image, params=None):
+    """Estimate how long the gcode for an image would take to run
+
+    The gcode is generated as far as working out every move and how many
+    calls load each line, without writing the data out, and timed by
+    gcode_time().  Returns its estimate with the params it was made with.
+    """
+    params = dict(params or {}, estimate_only=True, actual_image=None)
+    for name in ('sidecar', 'stream'):
+        if params.get(name):
+            params[name] = os.devnull
+    p = dict(default_params)
+    p.update(params)
+    return gcode_time(generate_raster(image, params), p), p
+
+def estimate_report(estimate, p):
+    """Return lines describing an estimate_time() estimate"""
+    def hms(seconds):
+        return '%u:%02u:%02u' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    total = estimate['burn'] + estimate['lead'] + estimate['rapid'] + estimate['pause']
+    lines = ['about %s for %u raster lines, %u gcode lines' % (hms(total), estimate['sweeps'], estimate['lines']),
+             '  burning %s, lead in and out %s, rapids %s, stopped %s' % (
+                 hms(estimate['burn']), hms(estimate['lead']), hms(estimate['rapid']), hms(estimate['pause']))]
+    if estimate['sweeps']:
+        overhead = total - estimate['burn']
+        lines.append('  each line %0.3f s burning and %0.3f s overhead' % (
+            estimate['burn'] / estimate['sweeps'], overhead / estimate['sweeps']))
+    if estimate['sweeps'] and estimate['speed'] < p['SPEED']:
+        lines.append('  the INI limits the sweep to %0.1f, not SPEED=%s' % (estimate['speed'], p['SPEED']))
+    limits = axis_limits(p)
+    axis = 'y' if p['raster_axis'] == 'y' else 'x'
+    if limits[axis][1] < p['ACCEL']:
+        lines.append('  the INI limits acceleration to %0.1f, not ACCEL=%s, the lead in is short' % (
+            limits[axis][1], p['ACCEL']))
+    return lines
+
+def write_gcode(chunks, out, buffer_size=1<<16):
+    """Write gcode chunks to a file in blocks of about buffer_size bytes"""
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= buffer_size:
+            out.write(''.join(pending))
+            pending = []
+            pending_size = 0
+    if pending:
+        out.write(''.join(pending))
+    out.flush()
+
+
+def parse_param(text):
+    """Split a name=value command line argument into a parameter"""
+    import ast
+    name, sep, value = text.partition('=')
+    if not sep or name not in default_params:
+        raise ValueError('bad parameter %s, expected one of: %s' %
+                         (text, ', '.join(sorted(default_params))))
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        # plain strings like origin_loc=center
+        pass
+    return name, value
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Generate gcode to raster engrave an image')
+    parser.add_argument('image', nargs='?', help='image file to engrave')
+    parser.add_argument('-o', '--output', help='gcode file to write, default stdout')
+    parser.add_argument('-p', '--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a raster parameter')
+    parser.add_argument('--preview-dither', metavar='METHOD,...',
+                        help='save the image dithered with each method instead of making gcode, '
+                             'one of: ' + ', '.join(raster_dither.METHODS[1:]))
+    parser.add_argument('--calibration', type=float, metavar='STEP',
+                        help='make gcode to measure reverse_offset instead of engraving the image, '
+                             'bands of bars with reverse_offset STEP apart')
+    parser.add_argument('--estimate', action='store_true',
+                        help='print how long the job would take instead of making gcode')
+    args = parser.parse_args(argv)
+
+    try:
+        params = dict([parse_param(text) for text in args.param])
+    except ValueError as e:
+        parser.error(str(e))
+    if args.estimate:
+        if args.image and os.path.exists(args.image):
+            image_name = args.image
+        else:
+            from raster_gui import image_not_found
+            image_name = image_not_found()
+        try:
+            estimate, p = estimate_time(image_name, params)
+        except ValueError as e:
+            print(e)
+            return 1
+        print('\n'.join(estimate_report(estimate, p)))
+        return 0
+    if params.get('sidecar') is True:
+        if not args.output:
+            parser.error('sidecar=True needs -o, the .lrb file is named after it')
+        params['sidecar'] = os.path.splitext(args.output)[0] + '.lrb'
+    if params.get('stream') is True:
+        if not args.output:
+            parser.error('stream=True needs -o, the .stream file is named after it')
+        params['stream'] = os.path.splitext(args.output)[0] + '.stream'
+
+    if args.calibration:
+        out = open(args.output, 'w') if args.output else sys.stdout
+        try:
+            write_gcode(generate_calibration(args.calibration, params), out)
+        finally:
+            if args.output:
+                out.close()
+        return 0
+
+    if args.image and os.path.exists(args.image):
+        image_name = args.image
+    else:
+        from raster_gui import image_not_found
+        image_name = image_not_found()
 
-print('M68 E1 Q0 (end raster)')
+    if args.preview_dither:
+        p = dict(default_params)
+        p.update(params)
+        try:
+            timings = preview_dither(image_name, args.preview_dither.split(','), p)
+        except ValueError as e:
+            print(e)
+            return 1
+        for method, seconds in timings:
+            print('%s: %0.2f s' % (method, seconds))
+        return 0
 
-print('G0 X%0.4f Y%0.4f (go to start)' % (X,Y))
-print('M2')
-print('%')
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        write_gcode(generate_raster(image_name, params), out)
+    except ValueError as e:
+        print(e)
+        return 1
+    finally:
+        if args.output:
+            out.close()
+    return 0
 
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,600 @@
+#!/usr/bin/env python
+#
+# Replay raster_engrave.py gcode through laserraster.comp's step math
+#
+# The gcode is interpreted as far as the raster needs: G20/G21, G0/G1
+# moves, M67/M68 on the analog outputs laserraster reads, named parameters
+# and the o100-o102 subs.  Every change of the data index runs the same
+# header, data and line start logic as update() in laserraster.comp, and
+# each move while a line is active fires the steps of the step mask it
+# passes like make_pulses() does.  The burnt dots are put back on the
+# raster's pixel grid, which gives the image the machine would burn.
+# Sidecar lines load from the .lrb and streamed lines from the .stream
+# next to the gcode, as if halstreamer always keeps ahead of the head.
+# Step and repeat gcode gives the image of the whole batch.
+#
+# Motion is ideal: the laser on delay is taken as exactly compensated and
+# steps are counted from 0 at machine position 0.
+
+import os, sys, re
+from math import floor, fabs
+import numpy
+from PIL import Image
+import raster_engrave
+
+# M67 and M68 outputs laserraster is netted to, E1 is the data index
+INDEX_PIN = 1
+DATA_PINS = (2, 3, 4, 5)
+
+RUN_START_SHIFT = 28
+RUN_LEVEL_SHIFT = 24
+RUN_LENGTH_MASK = 0xffffff
+
+
+def machine_setup(ini_file):
+    """Return (machine_is_metric, [X scale, Y scale], [X length, Y length])"""
+    from ConfigParser import RawConfigParser
+    ini = RawConfigParser()
+    if not ini.read(ini_file):
+        raise ValueError('can not read %s' % ini_file)
+    metric = ini.get('TRAJ', 'LINEAR_UNITS').strip() == 'mm'
+    scales = []
+    lengths = []
+    for section in ('AXIS_0', 'AXIS_1'):
+        scales.append(float(ini.get(section, 'SCALE')))
+        lengths.append(float(ini.get(section, 'MAX_LIMIT')) - float(ini.get(section, 'MIN_LIMIT')))
+    return metric, scales, lengths
+
+def step_bits_for(bits):
+    """Bits a power level takes in the step mask"""
+    if bits <= 1:
+        return 1
+    if bits <= 2:
+        return 2
+    return 4
+
+
+class RasterSim(object):
+    """laserraster's update() and make_pulses() on recorded moves
+
+    Loaded lines are kept as arrays of mask steps and levels rather than a
+    bit mask, which is the same thing for everything that can be seen.
+    """
+
+    def __init__(self, machine_is_metric, scales, lengths, max_bits_per_dot=4):
+        self.machine_is_metric = machine_is_metric
+        self.scales = scales
+        # words of the mask the comp allocates for the whole of the longest axis
+        self.mask_words = max([int(numpy.ceil(l * s * step_bits_for(max_bits_per_dot) / 32.0))
+                               for l, s in zip(lengths, scales)])
+        self.last_index = 0
+        self.convert_scale = 1.0
+        self.axis = 0
+        self.reset_headers()
+        self.raster_speed = 0.0
+        self.direction = 1
+        self.load_direction = 1
+        self.dots_per_unit = 0.0
+        self.bits_per_float = 0
+        self.lead_in = 0.0
+        self.stride = 0
+        self.step_frac = 0
+        self.copy_dots = 0
+        self.can_load = False
+        self.loaded = False
+        self.load = self.new_line()
+        self.firing = None
+        self.counts = {'lines': 0, 'fired': 0, 'loaded': 0, 'skipped': 0,
+                       'wrong direction': 0, 'past data': 0}
+        # fired dots as (x, y, level) in machine units
+        self.burnt = []
+        # the entries of the -20 lines, from stream_lines()
+        self.stream = None
+
+    def reset_headers(self):
+        # the optional headers go back to their defaults with -2
+        self.bits_per_dot = 1
+        self.words_per_index = 1
+        self.encoding = 0
+        self.double_buffer = False
+        self.axis = 0
+        self.copies = 1
+        self.forward_offset = 0
+        self.reverse_offset = 0
+
+    def new_line(self):
+        # end is the step of the last dot loaded, like m_loadEnd
+        return dict(steps=[], levels=[], end=0, mask=None)
+
+    def set_dot_steps(self, steps_per_dot):
+        whole = floor(steps_per_dot + 0.5)
+        if whole >= 1 and fabs(steps_per_dot - whole) < 1e-6:
+            self.stride = int(whole)
+        else:
+            self.stride = 0
+            # rounded up so whole products of the exact ratio stay whole
+            self.step_frac = int(steps_per_dot * 4294967296.0) + 1
+
+    def dot_step(self, dot):
+        if self.stride:
+            return dot * self.stride
+        return (dot * self.step_frac) >> 32
+
+    def dot_steps(self, dots):
+        dots = numpy.asarray(dots, dtype=numpy.uint64)
+        if self.stride:
+            return (dots * numpy.uint64(self.stride)).astype(numpy.int64)
+        return ((dots * numpy.uint64(self.step_frac)) >> numpy.uint64(32)).astype(numpy.int64)
+
+    def update(self, index, data, position):
+        """Run update() for a change of the data index to index"""
+        index = int(index)
+        if index == self.last_index:
+            return
+        self.last_index = index
+        if index > 0:
+            self.bulk([(index, data)], position)
+            return
+        start_line = False
+
+        if index == 0:
+            self.firing = None
+            self.can_load = False
+            self.loaded = False
+        elif index == -1:
+            if self.double_buffer:
+                self.load_direction = 1 if data[0] > 0 else -1
+            else:
+                self.firing = None
+            self.load = self.new_line()
+            self.copies = 1
+            self.can_load = True
+            self.loaded = False
+        elif index == -13:
+            self.firing = None
+            if self.loaded:
+                self.direction = self.load_direction
+                start_line = True
+                self.loaded = False
+        elif index == -20:
+            if self.can_load:
+                self.layout_mask()
+                start_line = True
+        elif index == -22:
+            # the last line again, its load is still there
+            if not self.double_buffer:
+                self.firing = None
+                self.can_load = False
+                self.loaded = True
+                start_line = True
+        else:
+            self.header(index, data)
+
+        if start_line:
+            self.start_line(position)
+        if index == -20:
+            # as if the streamer always keeps ahead of the head
+            if self.stream is None or int(data[0]) >= len(self.stream):
+                raise ValueError('the gcode streams line %u and the .stream file has no such line' % data[0])
+            for index, data in self.stream[int(data[0])]:
+                if self.loaded:
+                    self.load_words(index, data)
+
+    def bulk(self, entries, position):
+        """Load (index, words) entries like the bulk pins do"""
+        start_line = False
+        for index, data in entries:
+            if index <= 0:
+                continue
+            if self.can_load:
+                self.layout_mask()
+                if not self.double_buffer:
+                    start_line = True
+            if self.loaded:
+                # a firing single buffered line grows as it loads, it is
+                # the same line
+                self.load_words(index, data)
+
+        if start_line:
+            self.start_line(position)
+
+    def layout_mask(self):
+        self.step_bits = step_bits_for(self.bits_per_dot)
+        self.mask_steps = self.mask_words * (32 // self.step_bits)
+        self.level_mask = (1 << self.bits_per_dot) - 1
+        self.loaded = True
+        self.can_load = False
+
+    def header(self, index, data):
+        value = data[0]
+        if index == -2:
+            gcode_is_metric = int(value)
+            if not self.machine_is_metric and gcode_is_metric:
+                self.convert_scale = 1/25.4
+            elif self.machine_is_metric and not gcode_is_metric:
+                self.convert_scale = 25.4
+            else:
+                self.convert_scale = 1.0
+            self.reset_headers()
+        elif index == -3:
+            self.raster_speed = value * self.convert_scale
+        elif index == -4:
+            self.direction = 1 if value > 0 else -1
+            self.load_direction = self.direction
+        elif index == -5:
+            self.dots_per_unit = value / self.convert_scale
+            self.set_dot_steps(self.scales[self.axis] / self.dots_per_unit)
+        elif index == -6:
+            self.bits_per_float = int(value)
+        elif index == -8:
+            self.lead_in = value * self.convert_scale
+        elif index == -9:
+            self.bits_per_dot = min(4, max(1, int(value)))
+        elif index == -10:
+            self.words_per_index = min(len(DATA_PINS), max(1, int(value)))
+        elif index == -11:
+            self.encoding = int(value)
+        elif index == -12:
+            self.double_buffer = value != 0
+        elif index == -17:
+            self.axis = 1 if int(value) == 1 else 0
+            if self.dots_per_unit > 0:
+                self.set_dot_steps(self.scales[self.axis] / self.dots_per_unit)
+        elif index == -18:
+            self.forward_offset = int(floor(value * self.convert_scale * self.scales[self.axis] + 0.5))
+        elif index == -19:
+            self.reverse_offset = int(floor(value * self.convert_scale * self.scales[self.axis] + 0.5))
+        elif index == -23:
+            self.copy_dots = int(value)
+        elif index == -24:
+            self.copies = max(1, int(value))
+        # -7 and -14 to -16 only change pulse widths
+
+    def load_words(self, index, data):
+        line = self.load
+        for w in xrange(self.words_per_index):
+            word = int(data[w])
+            dots = None
+            if self.encoding == 1:
+                length = word & RUN_LENGTH_MASK
+                # zero words pad out the last index
+                if length:
+                    first = word >> RUN_START_SHIFT
+                    dots = numpy.arange(first, first + length)
+                    levels = numpy.repeat(numpy.uint8((word >> RUN_LEVEL_SHIFT) & self.level_mask), length)
+                    line['end'] = self.dot_step(first + length - 1)
+            else:
+                dots_per_float = self.bits_per_float // self.bits_per_dot
+                first = ((index - 1) * self.words_per_index + w) * dots_per_float
+                # the line ends at its last burnt dot like set_word()
+                if word:
+                    shifts = numpy.arange(dots_per_float, dtype=numpy.uint64) * numpy.uint64(self.bits_per_dot)
+                    levels = (numpy.uint64(word) >> shifts) & numpy.uint64(self.level_mask)
+                    dots = numpy.flatnonzero(levels)
+                    levels = levels[dots].astype(numpy.uint8)
+                    dots += first
+                    if len(dots):
+                        line['end'] = max(line['end'], self.dot_step(int(dots[-1])))
+            if dots is not None and len(dots):
+                steps = self.dot_steps(dots)
+                inside = steps < self.mask_steps
+                self.counts['loaded'] += int(inside.sum())
+                self.counts['skipped'] += len(steps) - int(inside.sum())
+                line['steps'].append(steps[inside])
+                line['levels'].append(levels[inside])
+                line['mask'] = None
+
+    def mask(self, line):
+        """Return the (steps, levels) of a line's step mask, by step"""
+        if line['mask'] is None:
+            if line['steps']:
+                steps = numpy.concatenate(line['steps'])
+                levels = numpy.concatenate(line['levels'])
+            else:
+                steps = numpy.zeros(0, dtype=numpy.int64)
+                levels = numpy.zeros(0, dtype=numpy.uint8)
+            # levels of dots that land on the same step are or'ed together
+            order = numpy.argsort(steps, kind='mergesort')
+            steps, levels = steps[order], levels[order]
+            if len(steps):
+                starts = numpy.flatnonzero(numpy.r_[True, steps[1:] != steps[:-1]])
+                levels = numpy.bitwise_or.reduceat(levels, starts)
+                steps = steps[starts]
+            line['mask'] = (steps, levels)
+        return line['mask']
+
+    def start_line(self, position):
+        self.counts['lines'] += 1
+        counts = self.step_count(position)
+        # float to s32 truncates like the comp
+        start = int(counts + self.lead_in * self.scales[self.axis] * self.direction)
+        start += self.forward_offset if self.direction > 0 else self.reverse_offset
+        copy_steps = self.dot_step(self.copy_dots) if self.copies > 1 else 0
+        self.firing = dict(line=self.load, start=start, direction=self.direction, axis=self.axis,
+                           copies=self.copies, copy_steps=copy_steps)
+
+    def step_count(self, position):
+        return int(floor(position[self.axis] * self.scales[self.axis] + 0.5))
+
+    def move(self, start, end):
+        """make_pulses() over a move from start to end, (x, y) machine units"""
+        line = self.firing
+        if line is None:
+            return
+        axis = line['axis']
+        scale = self.scales[axis]
+        a = int(floor(start[axis] * scale + 0.5))
+        b = int(floor(end[axis] * scale + 0.5))
+        if a == b:
+            return
+        direction = line['direction']
+        if (b - a) * direction < 0:
+            self.firing = None
+            self.counts['wrong direction'] += 1
+            return
+
+        # steps the move passes counted from the line start, as far as the
+        # data goes, the step it starts on has already been seen
+        first = (a - line['start']) * direction + 1
+        last = (b - line['start']) * direction
+        data_end = line['line']['end']
+        steps, levels = self.mask(line['line'])
+        (copies, copy_steps) = (line['copies'], line['copy_steps'])
+        if copies > 1 and copy_steps > 0:
+            # each copy burns the steps of the mask up to the next, the last all of them
+            data_end += (copies - 1) * copy_steps
+            whole = steps < copy_steps
+            steps = numpy.concatenate([steps[whole] + c*copy_steps for c in xrange(copies - 1)] +
+                                      [steps + (copies - 1)*copy_steps])
+            levels = numpy.concatenate([levels[whole]] * (copies - 1) + [levels])
+        fired = (steps >= max(first, 0)) & (steps <= min(last, data_end))
+        steps, levels = steps[fired], levels[fired]
+        self.counts['fired'] += len(steps)
+        if len(steps):
+            along = (line['start'] + steps * direction) / scale
+            # the other axis where the head is at each fired step
+            t = (along - start[axis]) / (end[axis] - start[axis])
+            other = start[1-axis] + t * (end[1-axis] - start[1-axis])
+            xy = (along, other) if axis == 0 else (other, along)
+            self.burnt.append((xy[0], xy[1], levels))
+        if last > data_end:
+            self.firing = None
+            self.counts['past data'] += 1
+
+
+def run_gcode(lines, sim, sidecar_name=None):
+    """Interpret gcode lines, feeding the analog outputs and moves to sim
+
+    M150 loads lines from the .lrb file sidecar_name like rasterload.py.
+
+    Returns a dict of the raster comments raster_engrave.py writes, which
+    say where the raster is, and whether the gcode ended up metric.
+    """
+    subs = {}
+    sub = None
+    params = {}
+    pins = [0.0] * (max(DATA_PINS) + 1)
+    pending = {}
+    gcode_metric = False
+    position = [0.0, 0.0]
+    notes = {}
+    sidecar = None
+    number = re.compile(r'([A-Z])\s*(\[[^\]]*\]|[-+]?[\d.]+)')
+
+    def value(text):
+        text = text.strip()
+        if text.startswith('['):
+            text = text[1:-1].strip()
+        if text.startswith('#<'):
+            return params[text[2:-1]]
+        return float(text)
+
+    def output(e, q, immediate):
+        if immediate:
+            pins[e] = q
+            if e == INDEX_PIN:
+                sim.update(q, [pins[d] for d in DATA_PINS], position)
+        else:
+            # motion sets the last value of each output as the next move starts
+            pending[e] = q
+
+    for line in lines:
+        text = line.strip()
+        if text.startswith('(') and text.endswith(')'):
+            m = re.match(r'\(raster upper right corner x=([-\d.]+),y=([-\d.]+)\)', text)
+            if m:
+                notes['X'], notes['Y'] = float(m.group(1)), float(m.group(2))
+            m = re.match(r'\(raster calculated size w=([-\d.]+),h=([-\d.]+)\)', text)
+            if m:
+                notes['W'], notes['H'] = float(m.group(1)), float(m.group(2))
+            m = re.match(r'\((?:rescaling|keeping) image (?:to|size) (\d+),(\d+) pixels\)', text)
+            if m:
+                notes['pix_w'], notes['pix_h'] = int(m.group(1)), int(m.group(2))
+            m = re.match(r'\(step and repeat \d+ copies, batch (\d+),(\d+) pixels, upper left '
+                         r'x=([-\d.]+),y=([-\d.]+), size w=([-\d.]+),h=([-\d.]+)\)', text)
+            if m:
+                # the raster is all the copies, not the one the notes above describe
+                notes['batch'] = dict(zip(('pix_w', 'pix_h'), map(int, m.groups()[:2])) +
+                                      zip(('X', 'Y', 'W', 'H'), map(float, m.groups()[2:])))
+            continue
+        text = re.sub(r'\([^)]*\)', '', text).strip()
+        if not text or text.startswith('/') or text == '%':
+            continue
+
+        words = text.split()
+        if sub is not None:
+            if words[0] == sub and words[1] == 'endsub':
+                sub = None
+            else:
+                subs[sub].append(text)
+            continue
+        if words[0].startswith('o') and len(words) > 1:
+            if words[1] == 'sub':
+                sub = words[0]
+                subs[sub] = []
+            elif words[1] == 'call':
+                args = [value(a) for a in re.findall(r'\[[^\]]*\]', text)]
+                for body in subs[words[0]]:
+                    body = re.sub(r'#(\d+)', lambda m: repr(args[int(m.group(1))-1]), body)
+                    m = re.match(r'M6([78])\s+E(\d+)\s+Q\[?([^\]]+)\]?', body)
+                    if m:
+                        output(int(m.group(2)), float(m.group(3)), m.group(1) == '8')
+            continue
+        m = re.match(r'#<(\w+)>\s*=\s*([-+\d.]+)', text)
+        if m:
+            params[m.group(1)] = float(m.group(2))
+            continue
+
+        codes = dict((letter, arg) for letter, arg in number.findall(text))
+        if codes.get('G') in ('20', '21'):
+            gcode_metric = codes['G'] == '21'
+        elif codes.get('M') in ('67', '68'):
+            output(int(codes['E']), value(codes['Q']), codes['M'] == '68')
+        elif codes.get('M') == '150':
+            if sidecar is None:
+                sidecar = raster_engrave.read_sidecar(sidecar_name)
+            job, words_per_index, starts, entries = sidecar
+            line = int(value(codes['P']))
+            if int(value(codes['Q'])) != job:
+                raise ValueError('%s is from job %u not %s' % (sidecar_name, job, codes['Q']))
+            line = entries[starts[line]:starts[line+1]]
+            sim.bulk([(int(entry['index']), [float(w) for w in entry['words']]) for entry in line], position)
+        elif codes.get('G') in ('0', '1'):
+            if pending:
+                for e in sorted(pending):
+                    if e != INDEX_PIN:
+                        pins[e] = pending[e]
+                if INDEX_PIN in pending:
+                    output(INDEX_PIN, pending[INDEX_PIN], True)
+                pending.clear()
+            to_machine = sim_units(gcode_metric, sim.machine_is_metric)
+            end = list(position)
+            for i, letter in enumerate('XY'):
+                if letter in codes:
+                    end[i] = value(codes[letter]) * to_machine
+            sim.move(position, end)
+            position = end
+    notes.update(notes.pop('batch', {}))
+    notes['metric'] = gcode_metric
+    return notes
+
+def stream_lines(name):
+    """Return the (index, words) entries of each line of a halstreamer file"""
+    lines = []
+    with open(name) as f:
+        for text in f:
+            sample = [int(v) for v in text.split()]
+            if sample[0] < 0:
+                # marker that starts line -index-1
+                lines.append([])
+            else:
+                lines[-1].append((sample[0], sample[1:]))
+    # the marker after the last line starts nothing
+    return lines[:-1]
+
+def sim_units(gcode_metric, machine_is_metric):
+    """Machine units per gcode unit"""
+    if machine_is_metric and not gcode_metric:
+        return 25.4
+    if gcode_metric and not machine_is_metric:
+        return 1/25.4
+    return 1.0
+
+def burn_image(sim, notes):
+    """Return the burnt dots on the raster's pixel grid
+
+    The array is bool, or power levels with more than one bit per dot.
+    """
+    for key in ('X', 'Y', 'W', 'H', 'pix_w', 'pix_h'):
+        if key not in notes:
+            raise ValueError('no raster size and position comments in the gcode')
+    to_machine = sim_units(notes['metric'], sim.machine_is_metric)
+    (pix_w, pix_h) = (notes['pix_w'], notes['pix_h'])
+    levels = numpy.zeros((pix_h, pix_w), dtype=numpy.uint8)
+    for x, y, level in sim.burnt:
+        cols = numpy.floor((x / to_machine - notes['X']) * pix_w / notes['W']).astype(int)
+        rows = numpy.floor((notes['Y'] - y / to_machine) * pix_h / notes['H']).astype(int)
+        inside = (cols >= 0) & (cols < pix_w) & (rows >= 0) & (rows < pix_h)
+        levels[rows[inside], cols[inside]] |= level[inside]
+    if sim.bits_per_dot == 1:
+        return levels != 0
+    return levels
+
+def image_levels(image, bits_per_dot):
+    """Return the dots of an actual_image from raster_engrave.py"""
+    if image.mode == '1':
+        return raster_engrave.image_dots(image)
+    gray = numpy.asarray(image.convert('L'), dtype=numpy.float64)
+    levels = numpy.floor((255 - gray) * ((1 << bits_per_dot) - 1) / 255.0 + 0.5).astype(numpy.uint8)
+    if bits_per_dot == 1:
+        return levels != 0
+    return levels
+
+def compare_dots(burnt, expected):
+    """Return the dots (missing, extra, at the wrong level) of a burn"""
+    missing = int(((expected != 0) & (burnt == 0)).sum())
+    extra = int(((burnt != 0) & (expected == 0)).sum())
+    level = int(((burnt != 0) & (expected != 0) & (burnt != expected)).sum())
+    return missing, extra, level
+
+def diff_image(burnt, expected):
+    """Black where both burn, red where a dot is missing, blue where one is extra"""
+    rgb = numpy.full(burnt.shape + (3,), 255, dtype=numpy.uint8)
+    both = (burnt != 0) & (expected != 0)
+    rgb[both] = (0, 0, 0)
+    rgb[(expected != 0) & (burnt == 0)] = (255, 0, 0)
+    rgb[(burnt != 0) & (expected == 0)] = (0, 0, 255)
+    rgb[both & (burnt != expected)] = (255, 0, 255)
+    return Image.fromarray(rgb)
+
+def simulate(gcode_name, ini_file):
+    """Return (burnt dots, sim) of a gcode file"""
+    machine_is_metric, scales, lengths = machine_setup(ini_file)
+    sim = RasterSim(machine_is_metric, scales, lengths)
+    stream_name = os.path.splitext(gcode_name)[0] + '.stream'
+    if os.path.exists(stream_name):
+        sim.stream = stream_lines(stream_name)
+    with open(gcode_name) as f:
+        notes = run_gcode(f, sim, os.path.splitext(gcode_name)[0] + '.lrb')
+    return burn_image(sim, notes), sim
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Burn raster gcode in simulation')
+    parser.add_argument('gcode', help='gcode from raster_engrave.py')
+    parser.add_argument('-o', '--output', default='burnt.png', help='image of the burnt dots to write')
+    parser.add_argument('--ini', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '40WLaser.ini'),
+                        help='LinuxCNC INI with the units, scales and limits of X and Y')
+    parser.add_argument('--compare', metavar='IMAGE',
+                        help='actual_image raster_engrave.py saved, exit 1 if the burn differs')
+    parser.add_argument('--diff', metavar='IMAGE', help='write where the burn and --compare differ')
+    args = parser.parse_args(argv)
+
+    try:
+        burnt, sim = simulate(args.gcode, args.ini)
+    except ValueError as e:
+        print(e)
+        return 2
+    raster_engrave.dots_image(burnt, sim.bits_per_dot).save(args.output)
+    print('%(lines)u lines, %(fired)u dots fired, %(loaded)u loaded, %(skipped)u past the step mask, '
+          '%(wrong direction)u lines stopped moving the wrong way, '
+          '%(past data)u past their data' % sim.counts)
+
+    if args.compare:
+        expected = image_levels(Image.open(args.compare), sim.bits_per_dot)
+        if expected.shape != burnt.shape:
+            print('%s is %ux%u, the raster is %ux%u' % ((args.compare,) + expected.shape[::-1] + burnt.shape[::-1]))
+            return 1
+        missing, extra, level = compare_dots(burnt, expected)
+        print('%u dots missing, %u extra, %u at the wrong level' % (missing, extra, level))
+        if args.diff:
+            diff_image(burnt, expected).save(args.diff)
+        if missing or extra or level:
+            return 1
+    # the head only turns back before a line's data ends on a fault
+    if sim.counts['wrong direction']:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Userspace HAL component loading raster lines from .lrb sidecar files
+#
+# raster_engrave.py -p sidecar=True writes the data words of every raster
+# line to a .lrb file next to the gcode, and the gcode loads each line with
+# M150 P<line> Q<job>.  mcodes/M150 hands the request to this process
+# through a fifo and waits for the reply, so the line is in laserraster's
+# step mask before the G1 that burns it.  The entries of a line go to
+# laserraster eight at a time on its bulk pins, each batch acknowledged on
+# bulk-ack, which takes a servo period or two.
+
+import os, sys, time, errno
+import hal, linuxcnc
+import raster_engrave
+
+# the fifos are this with .in and .out, mcodes/M150 has to agree
+FIFO = os.environ.get('RASTERLOAD_FIFO', '/tmp/rasterload')
+# laserraster's BULK_ENTRIES and MAX_WORDS_PER_INDEX
+BULK_ENTRIES = 8
+MAX_WORDS_PER_INDEX = 4
+# laserraster isn't running if a batch isn't taken in this long, seconds
+ACK_TIMEOUT = 1.0
+
+
+class Loader(object):
+    """Feed the lines of the running program's sidecar to laserraster"""
+
+    def __init__(self, comp):
+        self.comp = comp
+        self.stat = linuxcnc.stat()
+        self.name = None
+        self.sidecar = None
+        self.seq = 0
+
+    def open(self, job):
+        # the sidecar is named after the program, which may have been
+        # generated again since it was last opened
+        self.stat.poll()
+        name = os.path.splitext(self.stat.file)[0] + '.lrb'
+        if self.sidecar is None or name != self.name or self.sidecar[0] != job:
+            self.sidecar = raster_engrave.read_sidecar(name)
+            self.name = name
+        if self.sidecar[0] != job:
+            raise ValueError('%s is from job %u not %u, generate the gcode again' %
+                             (name, self.sidecar[0], job))
+
+    def load(self, line, job):
+        self.open(job)
+        job, words_per_index, starts, entries = self.sidecar
+        if not 0 <= line < len(starts) - 1:
+            raise ValueError('%s has no line %u' % (self.name, line))
+        end = int(starts[line+1])
+        for first in xrange(int(starts[line]), end, BULK_ENTRIES):
+            batch = entries[first:min(first + BULK_ENTRIES, end)]
+            for e, entry in enumerate(batch):
+                self.comp['bulk-index-%u' % e] = int(entry['index'])
+                for w in xrange(words_per_index):
+                    self.comp['bulk-data-%02u' % (e*MAX_WORDS_PER_INDEX + w)] = float(entry['words'][w])
+            self.comp['bulk-count'] = len(batch)
+            # laserraster loads the batch when bulk-seq changes
+            self.seq = (self.seq + 1) & 0xffffffff
+            self.comp['bulk-seq'] = self.seq
+            timeout = time.time() + ACK_TIMEOUT
+            while self.comp['bulk-ack'] != self.seq:
+                if time.time() > timeout:
+                    raise ValueError('laserraster did not take the data, is it enabled?')
+                time.sleep(0.0005)
+
+def reply(text):
+    # M150 opens the reply fifo after writing its request, so wait a
+    # little for it, but never hang if it has gone away
+    timeout = time.time() + ACK_TIMEOUT
+    while True:
+        try:
+            fd = os.open(FIFO + '.out', os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO or time.time() > timeout:
+                return
+            time.sleep(0.001)
+    os.write(fd, text + '\n')
+    os.close(fd)
+
+def serve(loader):
+    for name in (FIFO + '.in', FIFO + '.out'):
+        if os.path.exists(name):
+            os.remove(name)
+        os.mkfifo(name)
+
+    while True:
+        with open(FIFO + '.in') as f:
+            request = f.read().split()
+        try:
+            # M150 passes P and Q as floats
+            line, job = [int(float(value)) for value in request]
+            loader.load(line, job)
+            reply('ok')
+        except (ValueError, IOError, OSError) as e:
+            # a line without its data would be skipped, stop the job instead
+            linuxcnc.command().abort()
+            print('rasterload: %s' % e)
+            reply('error %s' % e)
+
+def main():
+    comp = hal.component('rasterload')
+    comp.newpin('bulk-seq', hal.HAL_U32, hal.HAL_OUT)
+    comp.newpin('bulk-count', hal.HAL_U32, hal.HAL_OUT)
+    for e in xrange(BULK_ENTRIES):
+        comp.newpin('bulk-index-%u' % e, hal.HAL_S32, hal.HAL_OUT)
+    for w in xrange(BULK_ENTRIES * MAX_WORDS_PER_INDEX):
+        comp.newpin('bulk-data-%02u' % w, hal.HAL_FLOAT, hal.HAL_OUT)
+    comp.newpin('bulk-ack', hal.HAL_U32, hal.HAL_IN)
+    comp.ready()
+    try:
+        serve(Loader(comp))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())